@@ -0,0 +1,269 @@
+"""Benchmarks the ingest, embed, and evaluate hot paths
+
+Times each of these on synthetic records from synthetic.py:
+
+    tokenize         `tokenize()` from tf_idf.py on arXiv-style abstracts
+    arxiv_convert    parsing arXiv snapshot lines and converting them to
+                     bulk actions, as load_arxiv_historical.py does
+    osf_convert      converting OSF API records to bulk actions, as
+                     load_osf_historical.py does
+    tf_idf_fit       fitting the TF-IDF model, as tf_idf.py does
+    tf_idf_transform creating embeddings with the fitted model
+    avg_distance     `avg_distance()` from model_tests.py on one category
+                     worth of embeddings
+    bulk_index       `bulk_index()` from partitions.py, against a stub
+                     elasticsearch server running in this process, so
+                     that it measures the client side of indexing
+                     (routing, serialization, and the bulk helper) rather
+                     than elasticsearch itself
+    export_1_slice   `export_corpus()` from corpus_export.py, in publish
+    export_4_slices      date order, with 1 and 4 slices, against the stub
+                     server with a fixed delay for each page it returns
+
+Each benchmark is run `--repeat` times (after one untimed warm-up run)
+and the minimum and median times are reported, along with items per
+second based on the minimum. Results are saved as JSON, along with the
+git commit they were measured on, so that a later run can be compared
+with an earlier one, e.g.:
+
+    git checkout abc123
+    python -m benchmarks.run -o bench-abc123.json
+    git checkout def456
+    python -m benchmarks.run -o bench-def456.json --compare bench-abc123.json
+
+Run this from the root of the repository. The tokenize and TF-IDF
+benchmarks need the nltk data that tf_idf.py uses to be downloaded.
+"""
+
+import gc
+import sys
+import json
+import time
+import platform
+import functools
+import statistics
+import subprocess
+from datetime import datetime
+
+import numpy as np
+
+from benchmarks import synthetic
+
+
+def timeit(func, repeat=5):
+    """Calls `func()` once to warm up and then `repeat` times, and
+    returns the time of each timed call in seconds."""
+    func()
+    times = []
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def bench_tokenize(n, seed):
+    from embeddings.tf_idf import tokenize
+
+    docs = synthetic.abstracts(n, seed)
+    return (lambda: [tokenize(d) for d in docs]), n
+
+
+def bench_arxiv_convert(n, seed):
+    from load_arxiv_historical import to_preprint
+
+    lines = [json.dumps(r) for r in synthetic.arxiv_records(n, seed)]
+    return (lambda: [to_preprint(json.loads(l)).to_dict(True) for l in lines]), n
+
+
+def bench_osf_convert(n, seed):
+    from load_osf_historical import to_preprint
+
+    records = synthetic.osf_records(n, seed)
+    return (lambda: [to_preprint(r).to_dict(True) for r in records]), n
+
+
+class _Doc:
+    """Stands in for a `Preprint` from elasticsearch, which is what
+    tf_idf.py's `tokenizer()` expects."""
+    __slots__ = ("abstract",)
+
+    def __init__(self, abstract):
+        self.abstract = abstract
+
+
+def _tf_idf_model():
+    from sklearn.feature_extraction.text import TfidfVectorizer
+    from embeddings.tf_idf import tokenizer
+
+    return TfidfVectorizer(lowercase=False, tokenizer=tokenizer, token_pattern=None)
+
+
+def bench_tf_idf_fit(n, seed):
+    docs = [_Doc(a) for a in synthetic.abstracts(n, seed)]
+    return (lambda: _tf_idf_model().fit(docs)), n
+
+
+def bench_tf_idf_transform(n, seed):
+    docs = [_Doc(a) for a in synthetic.abstracts(n, seed)]
+    model = _tf_idf_model().fit(docs)
+    return (lambda: model.transform(docs)), n
+
+
+def bench_avg_distance(n, seed):
+    from sklearn.feature_extraction.text import TfidfVectorizer
+    from embeddings.model_tests import avg_distance
+
+    # a plain vectorizer, so this doesn't need the nltk data
+    embeddings = TfidfVectorizer().fit_transform(synthetic.abstracts(n, seed))
+    # items are the pairs of documents compared
+    return (lambda: avg_distance(embeddings)), n * (n - 1) // 2
+
+
+def bench_bulk_index(n, seed):
+    from elasticsearch_dsl import connections
+    from benchmarks.stub_server import start_stub_server
+    from elastic.partitions import bulk_index
+    from load_arxiv_historical import to_preprint
+
+    server = start_stub_server()
+    client = connections.create_connection(
+        alias="benchmark", hosts=[f"localhost:{server.server_port}"], timeout=20)
+    records = synthetic.arxiv_records(n, seed)
+
+    def run():
+        # `bulk_index()` sets the index of each document, so they are
+        # made fresh each time
+        documents = [to_preprint(r) for r in records]
+        count = bulk_index(documents, client=client)
+        assert count == n, f"indexed {count} of {n} documents"
+
+    return run, n
+
+
+def bench_export_corpus(n, seed, slices=1):
+    from elasticsearch_dsl import connections
+    from benchmarks.stub_server import start_stub_server
+    from elastic.corpus_export import export_corpus
+    from load_arxiv_historical import to_preprint
+
+    documents = [json.loads(json.dumps(to_preprint(r).to_dict(), default=lambda d: d.isoformat()))
+                 for r in synthetic.arxiv_records(n, seed)]
+    # each page takes a while for the server to fetch, which is the
+    # latency that slicing overlaps
+    server = start_stub_server(documents=documents, page_delay=0.02)
+    client = connections.create_connection(
+        alias="benchmark", hosts=[f"localhost:{server.server_port}"], timeout=20)
+
+    def run():
+        count = sum(1 for _ in export_corpus(slices=slices, client=client, size=500))
+        assert count == n, f"exported {count} of {n} documents"
+
+    return run, n
+
+
+# name: (function, default number of items)
+BENCHMARKS = {
+    "tokenize": (bench_tokenize, 2000),
+    "arxiv_convert": (bench_arxiv_convert, 5000),
+    "osf_convert": (bench_osf_convert, 5000),
+    "tf_idf_fit": (bench_tf_idf_fit, 2000),
+    "tf_idf_transform": (bench_tf_idf_transform, 2000),
+    "avg_distance": (bench_avg_distance, 2000),
+    "bulk_index": (bench_bulk_index, 5000),
+    "export_1_slice": (functools.partial(bench_export_corpus, slices=1), 20000),
+    "export_4_slices": (functools.partial(bench_export_corpus, slices=4), 20000),
+}
+
+
+def git_commit():
+    """Returns the current git commit, with "-dirty" appended if there
+    are uncommitted changes, or None if it can't be found."""
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"],
+                                capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"],
+                               capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return f"{commit}-dirty" if dirty else commit
+
+
+def run_benchmarks(names, seed=0, repeat=5, scale=1.0):
+    """Runs the benchmarks in `names` and returns a dict of results,
+    with the number of items of each one scaled by `scale`."""
+    results = {}
+    for name in names:
+        func, default_n = BENCHMARKS[name]
+        n = max(2, int(default_n * scale))
+        run, items = func(n, seed)
+        times = timeit(run, repeat)
+        results[name] = {
+            "n": n,
+            "min": min(times),
+            "median": statistics.median(times),
+            "items_per_sec": items / min(times),
+        }
+        print(f"{name:<17} {n:>7}  {min(times):>9.4f}  {statistics.median(times):>9.4f}  "
+              f"{items / min(times):>12.1f}")
+    return results
+
+
+def compare(old, new):
+    """Prints the change in time of each benchmark in `new` relative to
+    `old` (both as saved by this script)."""
+    print(f"\nCompared with {old.get('commit')} ({old.get('timestamp')}):")
+    print("benchmark              old (s)    new (s)   change")
+    for name, result in new["results"].items():
+        if name not in old["results"]:
+            continue
+        before = old["results"][name]
+        if before["n"] != result["n"]:
+            print(f"{name:<17} skipped, different n ({before['n']} vs {result['n']})")
+            continue
+        ratio = result["min"] / before["min"]
+        print(f"{name:<17} {before['min']:>9.4f}  {result['min']:>9.4f}  {ratio:>7.2f}x")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("benchmarks", nargs="*",
+        help=f"Benchmarks to run (default all): {', '.join(BENCHMARKS)}")
+    parser.add_argument("-o", "--outfile", default="benchmarks.json", nargs="?",
+        help="Filename where results will be saved (default benchmarks.json)")
+    parser.add_argument("-c", "--compare", nargs="?",
+        help="Results file from an earlier run to compare against")
+    parser.add_argument("--seed", type=int, default=0, nargs="?",
+        help="Seed for the synthetic records (default 0)")
+    parser.add_argument("-r", "--repeat", type=int, default=5, nargs="?",
+        help="Number of timed runs of each benchmark (default 5)")
+    parser.add_argument("--scale", type=float, default=1.0, nargs="?",
+        help="Multiplies the number of items in each benchmark (default 1.0)")
+    args = parser.parse_args()
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error(f"unknown benchmark {name!r}")
+
+    print("benchmark               n    min (s)  median (s)   items/s")
+    results = run_benchmarks(args.benchmarks or list(BENCHMARKS),
+                             seed=args.seed, repeat=args.repeat, scale=args.scale)
+    output = {
+        "commit": git_commit(),
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "python": sys.version.split()[0],
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "seed": args.seed,
+        "repeat": args.repeat,
+        "results": results,
+    }
+    with open(args.outfile, "w") as f:
+        json.dump(output, f, indent=2)
+    print(f"Saved results to {args.outfile}")
+
+    if args.compare:
+        with open(args.compare, "r") as f:
+            compare(json.load(f), output)
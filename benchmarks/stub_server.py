@@ -0,0 +1,154 @@
+"""Stub elasticsearch server for benchmarking indexing and exports
+
+Answers just enough of the elasticsearch REST API for `bulk_index()` and
+`export_corpus()` to run against it:
+
+- every index exists, and alias and other PUT requests are acknowledged
+- bulk requests report every action as created (after reading and
+  counting them, so the request is fully sent); nothing is stored
+- scrolled searches (including sliced scrolls) page through a fixed
+  list of documents given when the server is started, with `_source`
+  filtering and sorting by `publish_date`
+
+Each search or scroll page can be delayed by `page_delay` seconds, to
+stand in for the time elasticsearch spends fetching a page. The delay
+doesn't hold the GIL, so it overlaps between slices the way the real
+work does, which is what makes slicing worthwhile. It runs in a
+background thread of the current process.
+"""
+
+import json
+import time
+import itertools
+import threading
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+_SHARDS = {"total": 1, "successful": 1, "skipped": 0, "failed": 0}
+
+
+def _sort_value(source):
+    """Returns the publish date of a document in epoch millis, as
+    elasticsearch returns it in a hit's `sort` values."""
+    date = source.get("publish_date")
+    if isinstance(date, str):
+        date = datetime.fromisoformat(date)
+    return int(date.timestamp() * 1000) if date is not None else 0
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def _reply(self, status=200, body=None):
+        data = json.dumps(body).encode() if body is not None else b""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(data)
+
+    def _read_body(self):
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def do_HEAD(self):
+        self._reply()
+
+    def do_GET(self):
+        self._reply(body={"version": {"number": "7.9.2"}, "tagline": "You Know, for Search"})
+
+    def do_PUT(self):
+        self._read_body()
+        self._reply(body={"acknowledged": True})
+
+    def do_DELETE(self):
+        body = self._read_body()
+        if urlsplit(self.path).path == "/_search/scroll":
+            scroll_ids = json.loads(body).get("scroll_id", []) if body else []
+            if isinstance(scroll_ids, str):
+                scroll_ids = [scroll_ids]
+            with self.server.lock:
+                for scroll_id in scroll_ids:
+                    self.server.scrolls.pop(scroll_id, None)
+            self._reply(body={"succeeded": True, "num_freed": len(scroll_ids)})
+        else:
+            self._reply(body={"acknowledged": True})
+
+    def do_POST(self):
+        body = self._read_body()
+        url = urlsplit(self.path)
+        if url.path.endswith("/_bulk"):
+            # every action is followed by its document
+            actions = body.count(b"\n") // 2
+            self.server.indexed += actions
+            items = [{"index": {"status": 201, "result": "created"}}] * actions
+            self._reply(body={"took": 1, "errors": False, "items": items})
+        elif url.path == "/_search/scroll":
+            self._scroll(json.loads(body)["scroll_id"])
+        elif url.path.endswith("/_search"):
+            self._search(json.loads(body) if body else {}, parse_qs(url.query))
+        else:
+            self._reply(body={"acknowledged": True})
+
+    def _search(self, body, params):
+        """Starts a scroll over the documents in the requested slice."""
+        documents = self.server.documents
+        if "slice" in body:
+            slice_id, slice_max = body["slice"]["id"], body["slice"]["max"]
+            documents = documents[slice_id::slice_max]
+        if any("publish_date" in s for s in body.get("sort", [])):
+            documents = sorted(documents, key=lambda d: d["sort"])
+
+        fields = body.get("_source", True)
+        hits = []
+        for doc in documents:
+            source = doc["_source"]
+            if isinstance(fields, list):
+                source = {f: source[f] for f in fields if f in source}
+            hits.append(dict(doc, _source=source))
+
+        size = int(params.get("size", [body.get("size", 10)])[0])
+        with self.server.lock:
+            scroll_id = str(next(self.server.scroll_counter))
+            self.server.scrolls[scroll_id] = (hits, size)
+        self._scroll(scroll_id, total=len(hits))
+
+    def _scroll(self, scroll_id, total=None):
+        """Replies with the next page of a scroll."""
+        time.sleep(self.server.page_delay)
+        with self.server.lock:
+            hits, size = self.server.scrolls.get(scroll_id, ([], 0))
+            page, rest = hits[:size], hits[size:]
+            if scroll_id in self.server.scrolls:
+                self.server.scrolls[scroll_id] = (rest, size)
+        if total is None:
+            total = len(hits)
+        self._reply(body={
+            "_scroll_id": scroll_id, "took": 1, "timed_out": False,
+            "_shards": _SHARDS,
+            "hits": {"total": {"value": total, "relation": "eq"}, "hits": page},
+        })
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stub_server(port=0, documents=(), index="preprint-2020", page_delay=0.0):
+    """Starts the stub server on `port` (by default, any free port) in a
+    daemon thread and returns it. `documents` is a list of `_source`
+    dicts that searches return, in the given `index`, with `_id`s in
+    order of the list. Its port is `server.server_port`, and
+    `server.indexed` counts the documents it has been sent."""
+    server = ThreadingHTTPServer(("localhost", port), StubHandler)
+    server.indexed = 0
+    server.documents = [{"_index": index, "_id": str(i), "_score": None,
+                         "_source": source, "sort": [_sort_value(source)]}
+                        for i, source in enumerate(documents)]
+    server.page_delay = page_delay
+    server.scrolls = {}
+    server.scroll_counter = itertools.count()
+    server.lock = threading.Lock()
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,190 @@
+"""Seeded synthetic preprint records for benchmarking
+
+Generates records in the same formats that the historical loaders read:
+lines of the arXiv metadata snapshot (as parsed JSON), and preprint
+records from the OSF API (as pickled by the download scripts, with the
+contributors and their users embedded). Abstracts are built from a
+fixed vocabulary of scientific-sounding words, and a share of them are
+sprinkled with inline LaTeX (`$...$` math and commands like `\\emph{}`)
+and hard line breaks, like the real arXiv abstracts are.
+
+The same seed always gives the same records, so timings on different
+commits are measured on the same data.
+"""
+
+import zlib
+import random
+from datetime import datetime, timedelta
+
+WORDS = """
+    model data analysis method results show propose network learning
+    theory field quantum energy system distribution function approach
+    dynamics structure effect study estimate sample measurement observed
+    effects behavior participants response social cognitive experiment
+    evidence significant framework algorithm performance training neural
+    graph optimal bound problem linear nonlinear equation solution space
+    group states phase transition temperature magnetic spin particle
+    galaxy stellar mass cosmological survey signal noise spectrum
+    frequency regression bayesian inference posterior prior variance
+    mean error robust efficient novel large small high low first second
+    using based between within across under over new present paper
+    recent previous however although therefore furthermore respectively
+""".split()
+
+LATEX = [
+    r"$\alpha$", r"$\beta = 0.5$", r"$O(n \log n)$", r"$\mathbb{R}^n$",
+    r"$\sigma_8$", r"$x^2 + y^2 = 1$", r"$\sqrt{s} = 13$ TeV",
+    r"$\lambda \to \infty$", r"$H_0$", r"$\ell_1$",
+    r"\emph{et al.}", r"\textit{in situ}", r"\cite{smith2019}",
+    r"\textbf{new}", r"$\sim 10^{4}$",
+]
+
+FIRST_NAMES = ["Anna", "José", "Wei", "Fatima", "Jürgen", "Priya",
+               "Olivier", "Mikhail", "Sarah", "Kenji", "Zoë", "Ahmed",
+               "Björn", "Chloé", "David", "Ľubomír"]
+LAST_NAMES = ["Smith", "García", "Zhang", "Müller", "Nguyen", "Ivanov",
+              "Kowalski", "O'Brien", "Tanaka", "Dubois", "Patel", "Hansen",
+              "Šimek", "Núñez", "van der Berg", "Schrödinger"]
+
+ARXIV_CATEGORIES = ["cs.LG", "cs.CL", "cs.CV", "stat.ML", "math.PR",
+                    "math.AG", "hep-th", "hep-ph", "astro-ph.CO",
+                    "astro-ph.GA", "cond-mat.str-el", "quant-ph",
+                    "physics.bio-ph", "q-bio.NC", "econ.EM",
+                    # older categories that the loader maps to new ones
+                    "alg-geom", "solv-int", "cmp-lg"]
+
+OSF_PROVIDERS = ["psyarxiv", "socarxiv", "engrxiv", "eartharxiv", "osf"]
+OSF_SUBJECTS = [
+    ["Social and Behavioral Sciences", "Psychology", "Cognitive Psychology"],
+    ["Social and Behavioral Sciences", "Sociology"],
+    ["Engineering", "Computer Engineering"],
+    ["Physical Sciences and Mathematics", "Earth Sciences", "Geology"],
+    ["Life Sciences", "Neuroscience and Neurobiology"],
+    ["Arts and Humanities", "Philosophy"],
+]
+
+START_DATE = datetime(2007, 1, 1)
+
+
+def abstract(rng, latex=True, words=(80, 250)):
+    """Returns a random abstract of between `words[0]` and `words[1]`
+    words. If `latex`, about half of abstracts include inline LaTeX."""
+    n = rng.randint(*words)
+    tokens = [rng.choice(WORDS) for _ in range(n)]
+    if latex and rng.random() < 0.5:
+        for _ in range(rng.randint(1, max(1, n // 20))):
+            tokens.insert(rng.randrange(n), rng.choice(LATEX))
+    # sentences of ~15 words, with the occasional number
+    sentences = []
+    for i in range(0, len(tokens), 15):
+        sentence = tokens[i:i + 15]
+        if rng.random() < 0.2:
+            sentence.insert(rng.randrange(len(sentence)),
+                            f"{rng.uniform(0, 100):.1f}%")
+        sentences.append(" ".join(sentence).capitalize() + ".")
+    return " ".join(sentences)
+
+
+def title(rng):
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(4, 12))).capitalize()
+
+
+def author_names(rng, n=None):
+    if n is None:
+        n = rng.randint(1, 6)
+    return [f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}" for _ in range(n)]
+
+
+def wrap(text, width=78):
+    """Inserts hard line breaks, like the arXiv snapshot has."""
+    lines, line = [], []
+    for word in text.split(" "):
+        if line and len(" ".join(line)) + len(word) >= width:
+            lines.append(" ".join(line))
+            line = []
+        line.append(word)
+    lines.append(" ".join(line))
+    return "\n  ".join(lines)
+
+
+def arxiv_record(rng, i):
+    """Returns one record in the format of a parsed line of the arXiv
+    metadata snapshot."""
+    created = START_DATE + timedelta(seconds=rng.randrange(14 * 365 * 86400))
+    versions = []
+    for v in range(rng.randint(1, 3)):
+        date = created + timedelta(days=30 * v)
+        versions.append({"version": f"v{v + 1}",
+                         "created": f"{date:%a}, {date.day} {date:%b %Y %H:%M:%S} GMT"})
+    return {
+        "id": f"{created:%y%m}.{i:05d}",
+        "submitter": author_names(rng, 1)[0],
+        "authors": ", ".join(author_names(rng)),
+        "title": wrap(title(rng)),
+        "comments": f"{rng.randint(5, 40)} pages, {rng.randint(1, 10)} figures",
+        "journal-ref": None,
+        "doi": None,
+        "abstract": "  " + wrap(abstract(rng)) + "\n",
+        "categories": " ".join(rng.sample(ARXIV_CATEGORIES, rng.randint(1, 3))),
+        "versions": versions,
+    }
+
+
+def osf_record(rng, i):
+    """Returns one preprint record in the format returned by the OSF API,
+    with contributors (and their users) embedded."""
+    created = START_DATE + timedelta(seconds=rng.randrange(14 * 365 * 86400))
+    published = None if rng.random() < 0.1 else created + timedelta(days=rng.randint(0, 5))
+    provider = rng.choice(OSF_PROVIDERS)
+    source_id = f"{i:05x}"
+
+    contributors = []
+    for name in author_names(rng):
+        user = {"data": {"attributes": {"full_name": name}}}
+        if rng.random() < 0.02:
+            # deleted users only have their name in the error
+            user = {"errors": [{"meta": {"full_name": name}}]}
+        contributors.append({"attributes": {"bibliographic": rng.random() < 0.95},
+                             "embeds": {"users": user}})
+
+    subjects = []
+    for chain in rng.sample(OSF_SUBJECTS, rng.randint(1, 2)):
+        subjects.append([{"id": f"{zlib.crc32(c.encode()):08x}", "text": c}
+                         for c in chain[:rng.randint(1, len(chain))]])
+
+    return {"data": {
+        "id": source_id,
+        "type": "preprints",
+        "attributes": {
+            "date_created": created.isoformat(timespec="microseconds"),
+            "date_published": published.isoformat(timespec="microseconds") if published else None,
+            "date_modified": (created + timedelta(days=rng.randint(0, 60))).isoformat(timespec="microseconds"),
+            "title": title(rng),
+            # OSF abstracts rarely have LaTeX in them
+            "description": abstract(rng, latex=rng.random() < 0.1),
+            "subjects": subjects,
+        },
+        "links": {"html": f"https://osf.io/preprints/{provider}/{source_id}/"},
+        "relationships": {"provider": {"links": {"related": {
+            "href": f"https://api.osf.io/v2/providers/preprints/{provider}/",
+            "meta": {}}}}},
+        "embeds": {"contributors": {"data": contributors}},
+    }}
+
+
+def arxiv_records(n, seed=0):
+    """Returns a list of `n` arXiv snapshot records."""
+    rng = random.Random(seed)
+    return [arxiv_record(rng, i) for i in range(n)]
+
+
+def osf_records(n, seed=0):
+    """Returns a list of `n` OSF API preprint records."""
+    rng = random.Random(seed)
+    return [osf_record(rng, i) for i in range(n)]
+
+
+def abstracts(n, seed=0):
+    """Returns a list of `n` arXiv-style abstracts."""
+    rng = random.Random(seed)
+    return [abstract(rng) for _ in range(n)]
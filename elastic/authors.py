@@ -0,0 +1,182 @@
+"""Normalizes author names into keys for matching authors across preprints
+
+Author names come in many forms: arXiv gives one free-text string of
+names (often with LaTeX accents like `M\\"uller` and affiliations in
+parentheses), while OSF gives each contributor's full name, sometimes in
+"Last, First" order. To find other preprints by the same authors without
+a fuzzy full-text query, each name is reduced to a key of the last name
+and first initial, with diacritics, punctuation, and case removed, e.g.
+"José García", "Garcia, J.", and "J. Garc\\'ia" all become "garcia_j".
+
+The keys are stored on each preprint in the `author_keys` keyword field
+when it is loaded, and can be looked up there with
+`same_author_query()`, or in a local memory-mapped index (see
+embeddings/author_index.py).
+
+When run directly as a script, this fills in `author_keys` for any
+preprints that don't have them yet (temporarily lifting the write block
+on finalized partitions, which are finalized again afterwards), e.g.:
+
+    python -m elastic.authors --backfill
+"""
+
+import re
+import unicodedata
+
+# LaTeX commands for letters, e.g. `\o` for "ø"
+_TEX_LETTERS = {"o": "o", "O": "O", "ss": "ss", "l": "l", "L": "L",
+                "ae": "ae", "AE": "AE", "oe": "oe", "OE": "OE",
+                "aa": "a", "AA": "A", "i": "i", "j": "j"}
+_TEX_LETTER_PATTERN = re.compile(r"\\(" + "|".join(sorted(_TEX_LETTERS, key=len, reverse=True))
+                                 + r")(?![a-zA-Z])")
+# LaTeX accents, e.g. `\'e`, `\"{u}`, `\c{c}`, or `\v s`
+_TEX_ACCENT_PATTERN = re.compile(r"\\(?:[`'^\"~=.]|[cvuHkdbrt](?=[\s{]))\s*")
+
+# letters that don't decompose into a base letter and a combining accent
+_LETTERS = str.maketrans({"ø": "o", "Ø": "O", "ł": "l", "Ł": "L", "ß": "ss",
+                          "æ": "ae", "Æ": "AE", "œ": "oe", "Œ": "OE",
+                          "đ": "d", "Đ": "D", "ð": "d", "þ": "th", "ı": "i"})
+
+# lowercase words that are part of the last name, e.g. "van der Berg"
+_PARTICLES = {"van", "von", "der", "den", "de", "del", "della", "di", "da",
+              "du", "le", "la", "dos", "das", "ter", "ten", "st"}
+_SUFFIXES = {"jr", "sr", "ii", "iii", "iv"}
+# names of groups rather than people, e.g. "The ATLAS Collaboration"
+_GROUPS = {"collaboration", "consortium", "group", "team"}
+
+
+def strip_accents(name):
+    """Converts LaTeX accents and letters to plain letters, and removes
+    diacritics from unicode letters."""
+    name = _TEX_LETTER_PATTERN.sub(lambda m: _TEX_LETTERS[m.group(1)], name)
+    name = _TEX_ACCENT_PATTERN.sub("", name)
+    name = name.replace("{", "").replace("}", "").translate(_LETTERS)
+    decomposed = unicodedata.normalize("NFKD", name)
+    return "".join(c for c in decomposed if not unicodedata.combining(c))
+
+
+def normalize_author(name):
+    """Returns the key of an author's name: the last name (including any
+    particles like "van der") and the first initial, in lowercase ASCII,
+    separated by an underscore. Names in "Last, First" order are
+    reordered first, and names of groups are kept whole. Returns None if
+    there is no name."""
+    name = strip_accents(name)
+    if "," in name:
+        last, _, first = name.partition(",")
+        if first.strip().strip(".").lower() in _SUFFIXES:
+            name = last
+        else:
+            name = f"{first} {last}"
+
+    words = []
+    for word in name.replace(".", ". ").split():
+        # keeps letters and digits only, so e.g. "O'Brien" is "obrien"
+        word = "".join(c for c in word.lower() if c.isalnum())
+        if word:
+            words.append(word)
+    while len(words) > 1 and words[-1] in _SUFFIXES:
+        words.pop()
+    if not words:
+        return None
+    if _GROUPS.intersection(words):
+        return "".join(w for w in words if w != "the")
+
+    start = len(words) - 1
+    while start > 1 and words[start - 1] in _PARTICLES:
+        start -= 1
+    last = "".join(words[start:])
+    if start == 0:
+        return last
+    return f"{last}_{words[0][0]}"
+
+
+def split_arxiv_authors(authors):
+    """Splits an arXiv author string into a list of names, e.g.
+    "A. Smith (MIT), B. Jones and C. Lee" -> ["A. Smith", "B. Jones",
+    "C. Lee"]."""
+    # removes affiliations, which can be nested, e.g. "((1) MIT)"
+    previous = None
+    while previous != authors:
+        previous = authors
+        authors = re.sub(r"\([^()]*\)", " ", authors)
+    # a colon usually follows a group name, e.g. "The ATLAS
+    # Collaboration: G. Aad, ...", which is split off as its own name
+    # "et al." doesn't always have a comma before it
+    authors = re.sub(r"\bet al\b\.?", ",", authors)
+    names = re.split(r",|;|:|&|\band\b", " ".join(authors.split()))
+    names = [n.strip() for n in names]
+    # a suffix is split off into a name of its own, e.g. "John Smith,
+    # Jr., Anna Lee", so those are dropped
+    return [n for n in names if n and n.strip(".").lower() not in _SUFFIXES]
+
+
+def author_keys(names):
+    """Returns the keys of a list of author names (or of an arXiv author
+    string), without duplicates, in order."""
+    if isinstance(names, str):
+        names = split_arxiv_authors(names)
+    keys = []
+    for name in names:
+        key = normalize_author(name)
+        if key is not None and key not in keys:
+            keys.append(key)
+    return keys
+
+
+def same_author_query(keys, exclude=None):
+    """Returns a query for preprints by any of the authors in `keys`,
+    scored by how many of them they share (not counting the preprint
+    with ID `exclude`)."""
+    query = {"bool": {
+        # each matching key adds 1 to the score
+        "should": [{"constant_score": {"filter": {"term": {"author_keys": k}}}}
+                   for k in keys],
+        "minimum_should_match": 1,
+    }}
+    if exclude is not None:
+        query["bool"]["must_not"] = [{"ids": {"values": [exclude]}}]
+    return query
+
+
+if __name__ == "__main__":
+    import os
+    import time
+    import argparse
+
+    from elasticsearch.helpers import bulk
+    from elasticsearch_dsl import connections
+
+    from elastic.corpus_export import export_corpus
+    from elastic.partitions import partitions, unblocked
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--backfill", action="store_true",
+        help="Fill in `author_keys` for preprints that don't have them yet")
+    parser.add_argument("--all", action="store_true",
+        help="With --backfill, recompute `author_keys` for every preprint")
+    parser.add_argument("names", nargs="*",
+        help="Author names to print the keys of")
+    args = parser.parse_args()
+
+    for name in args.names:
+        print(f"{name}\t{normalize_author(name)}")
+
+    if args.backfill:
+        elastic_host = f"{os.getenv('ELASTIC_ADMIN_USER')}:{os.getenv('ELASTIC_ADMIN_PASS')}@{os.getenv('ELASTIC_HOST')}"
+        connections.create_connection(hosts=[elastic_host], timeout=20)
+        client = connections.get_connection()
+
+        query = None
+        if not args.all:
+            query = {"bool": {"must_not": [{"exists": {"field": "author_keys"}}]}}
+        docs = export_corpus(query=query, fields=["authors"], ordered=False)
+        actions = ({"_op_type": "update", "_index": d._index, "_id": d._id,
+                    "doc": {"author_keys": author_keys(getattr(d, "authors", None) or [])}}
+                   for d in docs)
+
+        start_time = time.time()
+        with unblocked(client, [name for _, name in partitions(client)]):
+            count, _ = bulk(client, actions, chunk_size=1000)
+        elapsed = time.time() - start_time
+        print(f"Updated {count} preprints in {elapsed:.1f}s")
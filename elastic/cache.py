@@ -0,0 +1,222 @@
+"""Caches preprint search and recommendation results
+
+Most feed requests repeat the same category and date-window queries many
+times between ingests, so this keeps results in memory in front of
+elasticsearch. Entries are keyed by a normalized form of the query and
+its filters, evicted least-recently-used once the cache goes over a
+memory limit, and expire after a fixed time.
+
+Results also need to be thrown away when new preprints are loaded. The
+loaders call `bump_generation()` after each successful bulk load, which
+increments a counter stored in elasticsearch; the cache checks this
+counter (at most every few seconds) and clears itself when it changes.
+"""
+
+import sys
+import json
+import time
+import threading
+from collections import OrderedDict
+
+from elasticsearch.exceptions import NotFoundError
+
+from elastic.query import search_preprints
+
+GENERATION_INDEX = "ingest_generation"
+GENERATION_ID = "preprint"
+
+
+def get_generation(client):
+    """Returns the current ingest generation, or 0 if nothing has been
+    loaded since the counter was introduced."""
+    try:
+        doc = client.get(index=GENERATION_INDEX, id=GENERATION_ID)
+    except NotFoundError:
+        return 0
+    return doc["_source"]["generation"]
+
+
+def bump_generation(client):
+    """Increments the ingest generation, which invalidates all result
+    caches. Should be called by loaders after a bulk load succeeds."""
+    client.update(
+        index=GENERATION_INDEX, id=GENERATION_ID,
+        body={
+            "script": {"source": "ctx._source.generation += 1"},
+            "upsert": {"generation": 1},
+        },
+        refresh=True)
+
+
+def make_key(kind, query, **filters):
+    """Builds a cache key from the kind of request (e.g., "search"), the
+    query, and any filters. Queries are converted to dicts and dumped with
+    sorted keys, and list-valued filters are sorted, so that equivalent
+    requests get the same key."""
+    if hasattr(query, "to_dict"):
+        query = query.to_dict()
+    normalized = {}
+    for name, value in filters.items():
+        if hasattr(value, "to_dict"):
+            value = value.to_dict()
+        elif isinstance(value, (list, tuple, set)):
+            value = sorted(value, key=str)
+        normalized[name] = value
+    return json.dumps([kind, query, normalized], sort_keys=True,
+                      separators=(",", ":"), default=str)
+
+
+def estimate_size(obj, _depth=0):
+    """Roughly estimates the memory used by `obj`, including the objects
+    it contains (lists, tuples, dicts, and objects with `__slots__`)."""
+    size = sys.getsizeof(obj)
+    if _depth > 4:
+        return size
+    if isinstance(obj, (list, tuple, set)):
+        size += sum(estimate_size(o, _depth + 1) for o in obj)
+    elif isinstance(obj, dict):
+        size += sum(estimate_size(k, _depth + 1) + estimate_size(v, _depth + 1)
+                    for k, v in obj.items())
+    elif hasattr(obj, "__slots__"):
+        size += sum(estimate_size(getattr(obj, s, None), _depth + 1)
+                    for s in obj.__slots__)
+    return size
+
+
+class ResultCache:
+    """Least-recently-used cache of query results, limited to roughly
+    `max_bytes` of memory. Entries expire after `ttl` seconds, and the
+    whole cache is cleared when the ingest generation changes. The
+    generation is read from elasticsearch with `client` at most every
+    `check_interval` seconds; if `client` is None, the generation is
+    never checked and `invalidate()` has to be called manually.
+
+    Safe to use from multiple threads.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, ttl=300, client=None,
+                 check_interval=5):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.client = client
+        self.check_interval = check_interval
+
+        # key -> (value, size, expiry time, seconds taken to compute)
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._generation = None
+        self._last_check = 0
+        # incremented whenever the cache is cleared, so that results
+        # computed from before then aren't stored afterwards
+        self._epoch = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.time_saved = 0.0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _check_generation(self):
+        """Clears the cache if the ingest generation has changed."""
+        if self.client is None:
+            return
+        now = time.monotonic()
+        if now - self._last_check < self.check_interval:
+            return
+        self._last_check = now
+        generation = get_generation(self.client)
+        if generation != self._generation:
+            if self._generation is not None:
+                self.invalidate()
+            self._generation = generation
+
+    def invalidate(self):
+        """Removes all entries from the cache."""
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            self._epoch += 1
+            self.invalidations += 1
+
+    def get(self, key):
+        """Returns `(True, value)` if `key` is in the cache and has not
+        expired, otherwise `(False, None)`."""
+        self._check_generation()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return (False, None)
+            value, size, expiry, compute_time = entry
+            if time.monotonic() > expiry:
+                del self._entries[key]
+                self._bytes -= size
+                self.misses += 1
+                return (False, None)
+            self._entries.move_to_end(key)
+            self.hits += 1
+            self.time_saved += compute_time
+            return (True, value)
+
+    def put(self, key, value, compute_time=0.0, epoch=None):
+        """Adds `value` to the cache under `key`, evicting the least
+        recently used entries if this puts the cache over its memory
+        limit. Values larger than the whole cache are not stored. If
+        `epoch` (from `get_or_compute()`) is given and the cache has been
+        cleared since, the value may be stale, so it isn't stored."""
+        size = estimate_size(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if epoch is not None and epoch != self._epoch:
+                return
+            if key in self._entries:
+                self._bytes -= self._entries.pop(key)[1]
+            self._entries[key] = (value, size, time.monotonic() + self.ttl,
+                                  compute_time)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, (_, old_size, _, _) = self._entries.popitem(last=False)
+                self._bytes -= old_size
+                self.evictions += 1
+
+    def get_or_compute(self, key, compute):
+        """Returns the cached value for `key`, or calls `compute()` to get
+        it and caches the result."""
+        found, value = self.get(key)
+        if found:
+            return value
+        # if new preprints are loaded while this is computing, the result
+        # may be from before them, so it's only cached if the cache
+        # hasn't been cleared in the meantime
+        epoch = self._epoch
+        start_time = time.perf_counter()
+        value = compute()
+        self.put(key, value, time.perf_counter() - start_time, epoch=epoch)
+        return value
+
+    def stats(self):
+        """Returns a dict of cache metrics."""
+        requests = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / requests if requests > 0 else 0.0,
+            "time_saved": self.time_saved,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+        }
+
+
+def cached_search(cache, query, **kwargs):
+    """Same as `search_preprints()` from elastic/query.py, but returns
+    cached results when there are any."""
+    key = make_key("search", query,
+                   **{k: v for k, v in kwargs.items() if k != "client"})
+    return cache.get_or_compute(key, lambda: search_preprints(query, **kwargs))
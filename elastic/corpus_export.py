@@ -0,0 +1,200 @@
+"""Parallel export of the full preprint corpus from elasticsearch
+
+When imported, this provides `export_corpus()`, which reads every
+document in the preprint index using a sliced scroll: the index is split
+into N slices that are scrolled in parallel by worker threads, and only
+the requested `_source` fields are returned. If `ordered` is set, each
+slice is sorted by `publish_date` and the slices are merged back together
+so that documents come out in publish date order, which is what the
+training scripts rely on to hold out the most recent documents as a test
+set.
+
+When run directly as a script, it times a full export at various numbers
+of slices, e.g.:
+
+    python -m elastic.corpus_export --slices 1 2 4 8
+"""
+
+import heapq
+import queue
+import threading
+
+from elasticsearch.helpers import scan
+from elasticsearch_dsl import connections
+from elasticsearch_dsl.utils import AttrDict
+
+from elastic.elastic_mapping import Preprint
+
+# only the fields needed for training and evaluating models; in
+# particular, this skips `doc_vector`, which is by far the largest field
+DEFAULT_FIELDS = ["source_id", "publish_date", "abstract", "categories"]
+
+# marks the end of the results for a single slice
+_DONE = object()
+
+
+def _is_multi(field):
+    """Returns whether `field` of a `Preprint` can hold more than one
+    value."""
+    mapping = Preprint._doc_type.mapping
+    return field in mapping and mapping[field]._multi
+
+
+def _slice_worker(client, index, body, scroll, size, preserve_order,
+                  out_queue, stop_event, slice_id):
+    """Scrolls through a single slice of the index, putting pages of hits
+    onto `out_queue` as `(slice_id, hits)` tuples. Puts `_DONE` when the
+    slice is exhausted, or the exception if something goes wrong."""
+    def put(item):
+        # don't block forever if the consumer has stopped reading
+        while not stop_event.is_set():
+            try:
+                out_queue.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    try:
+        page = []
+        for hit in scan(client, query=body, index=index, scroll=scroll,
+                        size=size, preserve_order=preserve_order,
+                        clear_scroll=True):
+            page.append(hit)
+            if len(page) >= size:
+                if not put((slice_id, page)):
+                    return
+                page = []
+        if page and not put((slice_id, page)):
+            return
+        put((slice_id, _DONE))
+    except Exception as e:  # pass errors back to the consumer thread
+        put((slice_id, e))
+
+
+def _to_document(hit, fields=()):
+    """Converts a raw hit into a lightweight document with attribute
+    access (e.g., `doc.abstract`), without the overhead of creating a
+    full `Preprint` object. `fields` is a list of `(name, is_multi)`;
+    any of these that are missing from the hit (elasticsearch leaves out
+    empty lists) are set to an empty list for multi-valued fields or None
+    otherwise, as they would be on a `Preprint`."""
+    doc = hit["_source"]
+    for name, is_multi in fields:
+        if name not in doc:
+            doc[name] = [] if is_multi else None
+    doc["_id"] = hit["_id"]
+    # the concrete index (i.e., partition) that the document is in, which
+    # is needed to update it
+    doc["_index"] = hit["_index"]
+    return AttrDict(doc)
+
+
+def export_corpus(slices=4, fields=DEFAULT_FIELDS, ordered=True, query=None,
+                  index=None, client=None, scroll="5m", size=5000,
+                  max_pages=4):
+    """Generator that yields every document in the preprint index (or
+    every document matching `query`, a dict in the elasticsearch query
+    DSL), using `slices` parallel scrolls. Only `fields` are retrieved
+    from each document's `_source`.
+
+    If `ordered` is True, documents are yielded in ascending order of
+    `publish_date`; otherwise they are yielded in whatever order the
+    slices return them, which is somewhat faster. At most `max_pages`
+    pages of `size` hits are buffered per slice, so memory use stays
+    bounded regardless of the size of the index.
+    """
+    if client is None:
+        client = connections.get_connection()
+    if index is None:
+        index = Preprint._index._name
+
+    body = {"_source": list(fields)}
+    field_types = [(f, _is_multi(f)) for f in fields]
+    if query is not None:
+        body["query"] = query
+    if ordered:
+        body["sort"] = [{"publish_date": "asc"}]
+
+    # elasticsearch requires `max` to be at least 2 for a sliced scroll
+    bodies = []
+    if slices > 1:
+        for i in range(slices):
+            bodies.append(dict(body, slice={"id": i, "max": slices}))
+    else:
+        bodies.append(body)
+
+    stop_event = threading.Event()
+    if ordered:
+        queues = [queue.Queue(maxsize=max_pages) for _ in bodies]
+    else:
+        shared = queue.Queue(maxsize=max_pages * len(bodies))
+        queues = [shared] * len(bodies)
+
+    for i, b in enumerate(bodies):
+        threading.Thread(
+            target=_slice_worker,
+            args=(client, index, b, scroll, size, ordered, queues[i],
+                  stop_event, i),
+            daemon=True).start()
+
+    def read_slice(q):
+        """Yields hits from a single slice's queue until it is done."""
+        while True:
+            _, page = q.get()
+            if page is _DONE:
+                return
+            if isinstance(page, Exception):
+                raise page
+            yield from page
+
+    try:
+        if ordered:
+            # each slice is already sorted, so merging them keeps the
+            # whole stream sorted; `sort` holds the sort values of the
+            # hit (publish date in epoch millis)
+            streams = [read_slice(q) for q in queues]
+            for hit in heapq.merge(*streams, key=lambda h: h["sort"]):
+                yield _to_document(hit, field_types)
+        else:
+            remaining = len(bodies)
+            while remaining > 0:
+                _, page = shared.get()
+                if page is _DONE:
+                    remaining -= 1
+                    continue
+                if isinstance(page, Exception):
+                    raise page
+                for hit in page:
+                    yield _to_document(hit, field_types)
+    finally:
+        stop_event.set()
+
+
+if __name__ == "__main__":
+    import os
+    import time
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-s", "--slices", type=int, nargs="+", default=[1, 2, 4, 8],
+        help="Numbers of slices to time the export with (default 1 2 4 8)")
+    parser.add_argument("-m", "--max", type=int, nargs="?",
+        help="If set, stop each export after this many documents.")
+    parser.add_argument("--unordered", action="store_true",
+        help="Don't merge results back into publish date order.")
+    args = parser.parse_args()
+
+    elastic_host = f"{os.getenv('ELASTIC_ADMIN_USER')}:{os.getenv('ELASTIC_ADMIN_PASS')}@{os.getenv('ELASTIC_HOST')}"
+    connections.create_connection(hosts=[elastic_host], timeout=20)
+
+    print(f"Total: {Preprint.search().count()}")
+    for n in args.slices:
+        start_time = time.time()
+        count = 0
+        for _ in export_corpus(slices=n, ordered=not args.unordered):
+            count += 1
+            if args.max is not None and count >= args.max:
+                break
+        elapsed = time.time() - start_time
+        print(f"{n} slice(s): {count} documents in {elapsed:.2f}s ({count / elapsed:.0f} docs/s)")
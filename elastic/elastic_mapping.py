@@ -3,12 +3,32 @@
 When imported, this provides a class that identifies the relevant data
 for importing preprints into elasticsearch. When run directly as a script,
 it will initialize the mapping for a Preprint in the database if it does
-not already exist. This only needs to be done once, when the database is
-first set up.
+not already exist, or add any new fields to it if it does. This only
+needs to be done once, when the database is first set up. Preprints are
+stored in one index per year, all accessed through the "preprint" alias
+(see partitions.py); to change the mapping of an existing index, see
+migrate.py.
 """
 
+import os
+from datetime import datetime
+
 from elasticsearch_dsl import Date, DenseVector, Document, Keyword, Text
 
+# mapping options; these only take effect when an index is created, so
+# changing them for an existing index requires a reindex (see migrate.py)
+VECTOR_DIMS = int(os.getenv("PREPRINT_VECTOR_DIMS", "256"))
+
+# sorting the index by publish date (newest first) lets queries for the
+# most recent preprints stop early instead of sorting every match
+INDEX_SORT = os.getenv("PREPRINT_INDEX_SORT", "true").lower() == "true"
+
+# positions are only needed for phrase queries on titles and abstracts;
+# without them the index is smaller and matching is a bit faster
+PHRASE_SEARCH = os.getenv("PREPRINT_PHRASE_SEARCH", "true").lower() == "true"
+_text_options = {} if PHRASE_SEARCH else {"index_options": "freqs"}
+
+
 class Preprint(Document):
     """Stores data about preprints, including title, abstract, authors,
     dates, and document vectors."""
@@ -20,31 +40,93 @@ class Preprint(Document):
     modified_date = Date()
     stored_date = Date()
 
-    title = Text()
-    abstract = Text()
-    authors = Text(multi=True)
+    title = Text(**_text_options)
+    abstract = Text(**_text_options)
+    # the length of the author list shouldn't affect scoring, so norms
+    # are disabled; the keyword subfield (`authors.keyword`) has doc
+    # values for exact lookups and aggregations of OSF author names.
+    # arXiv authors are one string of every name, which can be longer
+    # than the largest term Lucene accepts (and would fail the whole
+    # document), so longer values are left out of the subfield; use
+    # `author_keys` for per-author lookups
+    authors = Text(multi=True, norms=False,
+                   fields={"keyword": Keyword(ignore_above=256)})
         # this will probably need to change, but I'm not sure the best
         # way to store author names
-    
+    # normalized "lastname_f" key of each author, for exact lookups of
+    # other preprints by the same authors; see authors.py
+    author_keys = Keyword(multi=True)
+
     categories = Keyword(multi=True)
     keywords = Keyword(multi=True)
 
-    doc_vector = DenseVector(dims=256)
-        # may need to adjust number of dimensions
+    doc_vector = DenseVector(dims=VECTOR_DIMS)
+
+    # near-duplicates (e.g., the same paper posted to both arXiv and
+    # PsyArXiv) share a cluster ID, which is the ID of the first of them
+    # to be published; see embeddings/dedup.py
+    duplicate_cluster = Keyword()
+    minhash_bands = Keyword(multi=True)
 
     class Index:
+        # this is an alias that points at the actual index, so that the
+        # index can be rebuilt with a new mapping without downtime
         name = "preprint"
-        # can set settings here as well:
-        # settings = { keys: values }
+        settings = {"index.sort.field": "publish_date",
+                    "index.sort.order": "desc"} if INDEX_SORT else {}
+
+
+def create_index(name=None):
+    """Creates a new index with the current `Preprint` mapping and
+    settings, and returns its name. By default the name is the alias
+    followed by a timestamp, e.g. "preprint-20201014093000"."""
+    if name is None:
+        name = f"{Preprint._index._name}-{datetime.now():%Y%m%d%H%M%S}"
+    Preprint._index.clone(name).create()
+    return name
+
+
+def update_mapping():
+    """Adds any fields that are new in the `Preprint` mapping to the
+    existing indices. (Changes to existing fields need a reindex.)"""
+    client = Preprint._get_connection()
+    client.indices.put_mapping(index=Preprint._index._name,
+                               body=Preprint._doc_type.mapping.to_dict())
+
+
+def switch_alias(alias, indices):
+    """Points `alias` at `indices` (either a single index name or a list
+    of them) and nothing else, in a single atomic update so that no
+    requests see the alias missing."""
+    if isinstance(indices, str):
+        indices = [indices]
+    client = Preprint._get_connection()
+    actions = []
+    if client.indices.exists_alias(name=alias):
+        for old_index in client.indices.get_alias(name=alias):
+            if old_index not in indices:
+                actions.append({"remove": {"index": old_index, "alias": alias}})
+    for index in indices:
+        actions.append({"add": {"index": index, "alias": alias}})
+    client.indices.update_aliases(body={"actions": actions})
 
 
 if __name__ == "__main__":
-    import os
+    import sys
     from elasticsearch_dsl import connections
 
+    # to allow importing from parent directory
+    sys.path.insert(1, os.path.join(sys.path[0], '..'))
+    from elastic.partitions import ensure_template, ensure_partition, partition_name
+
     elastic_host = f"{os.getenv('ELASTIC_ADMIN_USER')}:{os.getenv('ELASTIC_ADMIN_PASS')}@{os.getenv('ELASTIC_HOST')}"
     connections.create_connection(hosts=[elastic_host], timeout=20)
+    client = connections.get_connection()
 
+    ensure_template(client)
     if not Preprint._index.exists():
+        # other partitions are created as documents are loaded into them
         print("Initializing preprint index")
-        Preprint.init()
\ No newline at end of file
+        ensure_partition(client, partition_name(datetime.now()))
+    else:
+        update_mapping()
\ No newline at end of file
@@ -0,0 +1,130 @@
+"""Two-stage hybrid retrieval of preprints
+
+Keyword (BM25) search over titles and abstracts is cheap but doesn't
+rank results very well, while scoring every document's embedding against
+a query is expensive. This does both: it takes the top `candidates`
+preprints by BM25 score from elasticsearch, looks up their embeddings in
+a local `EmbeddingStore`, and reranks them with a blend of the
+(normalized) BM25 score and the cosine similarity to the query vector:
+
+    score = (1 - weight) * bm25 + weight * cosine
+
+When run directly as a script, it reports latency and quality at
+various settings of `candidates` and `weight`. Quality is measured as
+the proportion of the top results that share a category with a seed
+document, whose title and stored embedding are used as the query, e.g.:
+
+    python -m elastic.hybrid -e data/embeddings --candidates 50 200 1000
+"""
+
+import numpy as np
+
+from elastic.query import search_preprints
+from embeddings.embedding_store import normalize
+
+
+def _min_max(scores):
+    """Rescales `scores` to the range [0, 1]."""
+    low = scores.min()
+    high = scores.max()
+    if high == low:
+        return np.ones_like(scores)
+    return (scores - low) / (high - low)
+
+
+def rerank(hits, query_vector, store, weight=0.5):
+    """Reranks `hits` (a list of `PreprintHit`s with BM25 scores) by
+    blending their scores with the similarity of their embeddings in
+    `store` to `query_vector` (which is normalized first, so that this is
+    a cosine similarity whatever its length). Hits without an embedding
+    get the lowest similarity of the others. Returns the reranked list,
+    with each hit's `score` set to its blended score."""
+    if not hits:
+        return []
+    bm25 = _min_max(np.array([h.score or 0.0 for h in hits], dtype=np.float32))
+
+    # the stored vectors are already unit length
+    query_vector = normalize(query_vector)
+    rows = store.lookup([h.id for h in hits])
+    has_vector = rows >= 0
+    similarity = np.zeros(len(hits), dtype=np.float32)
+    if has_vector.any():
+        # one batched dot product for all the candidates at once
+        similarity[has_vector] = store.score(query_vector, rows[has_vector])
+        similarity[~has_vector] = similarity[has_vector].min()
+
+    blended = (1 - weight) * bm25 + weight * similarity
+    order = np.argsort(-blended, kind="stable")
+    results = []
+    for i in order:
+        hits[i].score = float(blended[i])
+        results.append(hits[i])
+    return results
+
+
+def hybrid_search(text, query_vector, store, size=10, candidates=200,
+                  weight=0.5, fields=("title", "abstract"), **kwargs):
+    """Searches for `text` in `fields`, then reranks the top `candidates`
+    results using their embeddings in `store` (see `rerank()`). Returns
+    the top `size` reranked `PreprintHit`s. Any other `kwargs` are passed
+    on to `search_preprints()`."""
+    query = {"multi_match": {"query": text, "fields": list(fields)}}
+    _, hits = search_preprints(query, size=candidates, **kwargs)
+    return rerank(hits, query_vector, store, weight=weight)[:size]
+
+
+if __name__ == "__main__":
+    import time
+    import random
+    import argparse
+    import statistics
+
+    from embeddings.embedding_store import EmbeddingStore
+    from elastic.elastic_mapping import Preprint
+    from elastic.query import get_client
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-e", "--embeddings", default="data/embeddings", nargs="?",
+        help="Directory of the embedding store (default data/embeddings)")
+    parser.add_argument("--candidates", type=int, nargs="+", default=[50, 200, 1000],
+        help="Numbers of BM25 candidates to rerank (default 50 200 1000)")
+    parser.add_argument("--weights", type=float, nargs="+", default=[0.0, 0.25, 0.5, 0.75, 1.0],
+        help="Blend weights of the embedding similarity (default 0 0.25 0.5 0.75 1)")
+    parser.add_argument("-n", "--num_queries", type=int, default=100, nargs="?",
+        help="Number of seed documents to query with (default 100)")
+    parser.add_argument("--size", type=int, default=10, nargs="?",
+        help="Number of results to evaluate for each query (default 10)")
+    args = parser.parse_args()
+
+    store = EmbeddingStore(args.embeddings)
+    client = get_client()
+
+    # pick seed documents that have embeddings
+    random.seed(42)
+    seed_rows = random.sample(range(len(store)), k=min(args.num_queries, len(store)))
+    seed_ids = [store.ids[r].decode() for r in seed_rows]
+    seeds = client.mget(index=Preprint._index._name, body={"ids": seed_ids},
+                        _source=["title", "categories"])["docs"]
+    seeds = [(s["_id"], s["_source"], store.get([r])[0])
+             for s, r in zip(seeds, seed_rows) if s.get("found")]
+
+    print("candidates  weight  median ms  p95 ms  category precision")
+    for n in args.candidates:
+        for w in args.weights:
+            timings = []
+            precisions = []
+            for seed_id, source, vector in seeds:
+                start_time = time.perf_counter()
+                results = hybrid_search(source["title"], vector, store,
+                                        size=args.size + 1, candidates=n, weight=w)
+                timings.append((time.perf_counter() - start_time) * 1000)
+
+                # the seed document itself doesn't count
+                results = [h for h in results if h.id != seed_id][:args.size]
+                if results:
+                    seed_cats = set(source.get("categories") or [])
+                    relevant = sum(1 for h in results if seed_cats & set(h.categories or []))
+                    precisions.append(relevant / len(results))
+            p95 = sorted(timings)[int(len(timings) * 0.95) - 1]
+            print(f"{n:>10}  {w:>6.2f}  {statistics.median(timings):>9.2f}  {p95:>6.2f}  "
+                  f"{statistics.mean(precisions) if precisions else float('nan'):.3f}")
@@ -0,0 +1,161 @@
+"""Migrates preprints to new partitions with the current mapping
+
+Some mapping options (e.g., index sorting, new subfields, or the number
+of dimensions of `doc_vector`) can only be set when an index is created.
+This copies all the documents into a new set of yearly partitions (see
+partitions.py) with elasticsearch's reindex API, and then points the
+"preprint" alias at them. An index can't be reindexed into itself, so
+the new partitions are named with a timestamp suffix, e.g.
+"preprint-2019-20201014093000". Run as a script, e.g.:
+
+    python -m elastic.migrate --benchmark
+
+Loaders should not run during a migration, since documents written to
+the old partitions after the reindex starts aren't copied, and loaders
+keep routing documents to the partitions that were in the alias when
+they started. The new partitions aren't finalized; run `python -m
+elastic.partitions --finalize` afterwards to finalize the historical
+ones again.
+
+Older databases have a concrete index named "preprint" rather than an
+alias. Since an alias can't have the same name as an index, the old
+index has to be deleted before the alias can be created; pass
+`--delete_old` to do this once the reindex has finished. Reads will fail
+for the moment between the delete and the alias being created.
+"""
+
+import time
+import statistics
+from datetime import datetime
+
+from elastic.elastic_mapping import create_index, switch_alias
+from elastic.partitions import ALIAS, ensure_template, partition_name
+
+# sends each document to the new partition for the year it was
+# published; dates are stored as ISO format strings, so the year is the
+# first four characters
+PARTITION_SCRIPT = """
+if (ctx._source.publish_date != null) {
+    ctx._index = params.prefix + ctx._source.publish_date.substring(0, 4) + params.suffix;
+}
+"""
+
+
+def reindex(client, source, dest, slices="auto", poll_interval=10,
+            script=None):
+    """Copies all documents from index `source` to index `dest`, waiting
+    for the reindex to finish and printing progress along the way. If
+    `script` (a dict in elasticsearch's script format) is given, it is run
+    on each document. Returns the final status of the reindex task."""
+    body = {"source": {"index": source}, "dest": {"index": dest}}
+    if script is not None:
+        body["script"] = script
+    task = client.reindex(body=body, slices=slices,
+                          wait_for_completion=False, refresh=True)
+    task_id = task["task"]
+    while True:
+        result = client.tasks.get(task_id=task_id)
+        status = result["task"]["status"]
+        print(f"Reindexed {status['created'] + status['updated']} / {status['total']}")
+        if result["completed"]:
+            if result.get("error") or result["response"]["failures"]:
+                raise RuntimeError(f"Reindex failed: {result.get('error') or result['response']['failures']}")
+            return status
+        time.sleep(poll_interval)
+
+
+def recency_query(category, size=20):
+    """Returns a request body for the newest preprints in `category`,
+    which is the query that index sorting is meant to speed up."""
+    return {
+        "query": {"bool": {"filter": [{"term": {"categories": category}}]}},
+        "sort": [{"publish_date": "desc"}],
+        "size": size,
+        # counting every match would stop the query from terminating early
+        "track_total_hits": False,
+        "_source": ["title"],
+    }
+
+
+def benchmark(client, index, categories, repeat=20):
+    """Times `recency_query()` for each of `categories` on `index`.
+    Returns the median and maximum time in milliseconds (as reported by
+    elasticsearch)."""
+    timings = []
+    for _ in range(repeat):
+        for cat in categories:
+            # skip the request cache, which would hide the query cost
+            response = client.search(index=index, body=recency_query(cat),
+                                     request_cache=False)
+            timings.append(response["took"])
+    return (statistics.median(timings), max(timings))
+
+
+def top_categories(client, index, n=5):
+    """Returns the `n` most common categories in `index`."""
+    response = client.search(index=index, body={
+        "size": 0,
+        "aggs": {"cats": {"terms": {"field": "categories", "size": n}}},
+    })
+    return [b["key"] for b in response["aggregations"]["cats"]["buckets"]]
+
+
+if __name__ == "__main__":
+    import os
+    import argparse
+
+    from elasticsearch_dsl import connections
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-s", "--source", nargs="?",
+        help="Index (or alias) to copy documents from (default is whatever the preprint alias points to)")
+    parser.add_argument("--delete_old", action="store_true",
+        help="Delete the source index after the reindex. Required when the source is a concrete index named after the alias.")
+    parser.add_argument("--benchmark", action="store_true",
+        help="Compare latency of recency queries on the old and new indices before switching the alias")
+    args = parser.parse_args()
+
+    elastic_host = f"{os.getenv('ELASTIC_ADMIN_USER')}:{os.getenv('ELASTIC_ADMIN_PASS')}@{os.getenv('ELASTIC_HOST')}"
+    connections.create_connection(hosts=[elastic_host], timeout=20)
+    client = connections.get_connection()
+
+    source = args.source or ALIAS
+    is_alias = client.indices.exists_alias(name=ALIAS)
+    if source == ALIAS and not is_alias and not args.delete_old:
+        parser.error(f"'{ALIAS}' is an index, not an alias; pass --delete_old to replace it with an alias after the reindex")
+
+    start_time = time.time()
+    # partitions are created as the reindex writes to them, and get their
+    # mapping from the template; documents without a publish date go to
+    # the current year's partition, which is created up front so that
+    # there is always one for new documents to be routed to
+    ensure_template(client)
+    suffix = f"{datetime.now():%Y%m%d%H%M%S}"
+    create_index(partition_name(datetime.now(), suffix))
+    print(f"Copying documents from {source} into yearly partitions...")
+    reindex(client, source, partition_name(datetime.now(), suffix), script={
+        "source": PARTITION_SCRIPT,
+        "params": {"prefix": f"{ALIAS}-", "suffix": f"-{suffix}"}})
+    dest = sorted(name for name in client.indices.get(index=f"{ALIAS}-*")
+                  if name.endswith(f"-{suffix}"))
+    print(f"Completed in {time.time() - start_time:.0f}s")
+
+    if args.benchmark:
+        categories = top_categories(client, source)
+        for index in [source, ",".join(dest)]:
+            median, worst = benchmark(client, index, categories)
+            print(f"{index}: median {median}ms, max {worst}ms")
+
+    old_indices = list(client.indices.get_alias(name=ALIAS)) if is_alias else [source]
+    if source == ALIAS and not is_alias:
+        # the alias can't be created until the index with its name is gone
+        print(f"Deleting {source}")
+        client.indices.delete(index=source)
+        switch_alias(ALIAS, dest)
+    else:
+        switch_alias(ALIAS, dest)
+        if args.delete_old:
+            for index in old_indices:
+                print(f"Deleting {index}")
+                client.indices.delete(index=index)
+    print(f"Alias {ALIAS} now points to {', '.join(dest)}")
@@ -0,0 +1,270 @@
+"""Time-partitioned preprint indices
+
+Rather than keeping every preprint in one index, preprints are split
+into one index per year of `publish_date` (e.g. "preprint-2019"), all
+behind the "preprint" alias. Searches through the alias still see
+everything, but queries for a recent date window can target only the
+partitions that cover it with `index_for_range()` (which
+`search_preprints()` in query.py does when it is given a date range),
+and historical partitions that won't change again can be force-merged
+and made read-only with `finalize_partition()`. Documents can still be
+written to finalized partitions inside `unblocked()`, which finalizes
+them again afterwards.
+
+Since an alias that points to several indices can't be written to,
+documents have to be routed to their partition before they are indexed;
+`route()` does this for a single `Preprint`, and `bulk_index()` routes
+and indexes a batch of them using several threads. A reindex with
+migrate.py copies documents into new partitions with a timestamp suffix
+(e.g. "preprint-2019-20201014093000") and moves the alias over to them;
+documents are always routed to the partition for their year that is in
+the alias.
+
+When run directly as a script, this can set up the index template,
+list partitions, or finalize historical partitions, e.g.:
+
+    python -m elastic.partitions --finalize
+"""
+
+import re
+import time
+import threading
+from datetime import datetime
+from contextlib import contextmanager
+
+from dateutil.parser import isoparse
+from elasticsearch.exceptions import RequestError
+from elasticsearch.helpers import parallel_bulk
+
+from elastic.elastic_mapping import Preprint, create_index
+
+ALIAS = Preprint._index._name
+# e.g. "preprint-2019", or "preprint-2019-20201014093000" for partitions
+# created by a reindex in migrate.py, which can't reuse the old names
+_PARTITION_PATTERN = re.compile(rf"^{re.escape(ALIAS)}-(\d{{4}})(?:-\d{{14}})?$")
+
+# partitions that are known to exist and be in the alias, so we only
+# need to check each one once per process
+_known_partitions = set()
+_partition_lock = threading.Lock()
+# the name of the partition in the alias for each year, as found by
+# `partition_for()`
+_year_partitions = {}
+
+# `(time, partitions)` from the last call to `partitions()` made by
+# `index_for_range()`, which is called for every date-filtered search
+_cached_partitions = (0, [])
+PARTITION_CACHE_SECONDS = 60
+
+
+def partition_name(date, suffix=None):
+    """Returns the name of a new partition for a publish date (either a
+    datetime or an ISO format string), with `suffix` (a timestamp, as
+    used by migrate.py) at the end if given."""
+    if isinstance(date, str):
+        date = isoparse(date)
+    if suffix is not None:
+        return f"{ALIAS}-{date.year}-{suffix}"
+    return f"{ALIAS}-{date.year}"
+
+
+def ensure_template(client):
+    """Creates (or updates) an index template so that any index matching
+    the partition naming pattern gets the `Preprint` mapping, even if it
+    is created implicitly (e.g., by a reindex)."""
+    body = Preprint._index.to_dict()
+    body["index_patterns"] = [f"{ALIAS}-*"]
+    client.indices.put_template(name=ALIAS, body=body)
+
+
+def ensure_partition(client, name):
+    """Creates partition `name` if it doesn't exist yet, and makes sure
+    it is in the alias. Safe to call from multiple threads."""
+    if name in _known_partitions:
+        return
+    with _partition_lock:
+        if name in _known_partitions:
+            return
+        if not client.indices.exists(index=name):
+            try:
+                create_index(name)
+            except RequestError as e:
+                # another process created it first
+                if e.error != "resource_already_exists_exception":
+                    raise
+        client.indices.put_alias(index=name, name=ALIAS)
+        _known_partitions.add(name)
+
+
+def partition_for(client, date):
+    """Returns the name of the partition in the alias for the year of a
+    publish date (either a datetime or an ISO format string), creating
+    one named by `partition_name()` if there isn't one yet."""
+    if isinstance(date, str):
+        date = isoparse(date)
+    name = _year_partitions.get(date.year)
+    if name is None:
+        # partitions created by migrate.py have a suffix, so the name
+        # can't just be worked out from the year
+        name = dict(partitions(client)).get(date.year, partition_name(date))
+        ensure_partition(client, name)
+        _year_partitions[date.year] = name
+    return name
+
+
+def route(preprint, client=None):
+    """Sets the index of `preprint` to the partition for its publish
+    date, creating the partition if needed. Returns the preprint."""
+    if client is None:
+        client = Preprint._get_connection()
+    preprint.meta.index = partition_for(client, preprint.publish_date)
+    return preprint
+
+
+def bulk_index(documents, client=None, thread_count=4, chunk_size=250):
+    """Routes each `Preprint` in `documents` to its partition and indexes
+    them, sending `chunk_size` documents per request from
+    `thread_count` threads. Raises an error if any document fails.
+    Returns the number of documents indexed.
+
+    Writes to finalized partitions fail, so a load that may include
+    documents from finalized years (e.g. backdated OSF preprints, or a
+    reload after `--finalize`) should call this inside `unblocked()`
+    for the whole load, so that each partition is only finalized again
+    once at the end rather than after every batch."""
+    if client is None:
+        client = Preprint._get_connection()
+    actions = (route(d, client).to_dict(True) for d in documents)
+    count = 0
+    for _ in parallel_bulk(client, actions, thread_count=thread_count,
+                           chunk_size=chunk_size):
+        count += 1
+    return count
+
+
+def partitions(client):
+    """Returns a sorted list of `(year, name)` for every partition in the
+    alias."""
+    if not client.indices.exists_alias(name=ALIAS):
+        return []
+    result = []
+    for name in client.indices.get_alias(name=ALIAS):
+        match = _PARTITION_PATTERN.match(name)
+        if match:
+            result.append((int(match.group(1)), name))
+    return sorted(result)
+
+
+def index_for_range(client, start, end=None):
+    """Returns the index names to search for preprints published between
+    `start` and `end` (default now), as a comma-separated string that can
+    be passed as the `index` of a search. Falls back to the whole alias
+    if no partitions cover the range, or if it goes past the newest
+    partition. The list of partitions is cached for
+    `PARTITION_CACHE_SECONDS`."""
+    global _cached_partitions
+    if end is None:
+        end = datetime.now()
+    checked, known = _cached_partitions
+    # partitions are only added when a new year's preprints arrive, so
+    # the list only needs to be refreshed now and then
+    if time.monotonic() - checked > PARTITION_CACHE_SECONDS:
+        known = partitions(client)
+        _cached_partitions = (time.monotonic(), known)
+    if not known or end.year > known[-1][0]:
+        # a partition for a newer year may have been created since the
+        # list was cached, so search everything to be safe
+        return ALIAS
+    names = [name for year, name in known
+             if start.year <= year <= end.year]
+    return ",".join(names) if names else ALIAS
+
+
+def finalize_partition(client, name):
+    """Force-merges partition `name` down to a single segment and blocks
+    writes to it. Should only be done once a partition is complete."""
+    client.indices.forcemerge(index=name, max_num_segments=1,
+                              request_timeout=3600)
+    client.indices.put_settings(index=name,
+                                body={"index.blocks.write": True})
+
+
+def finalized(client, names):
+    """Returns the names of the indices in `names` that have writes
+    blocked, with a single request."""
+    names = sorted(set(names))
+    if not names:
+        return []
+    settings = client.indices.get_settings(index=",".join(names),
+                                           name="index.blocks.write")
+    return [name for name in names
+            if settings.get(name, {}).get("settings", {}).get("index", {})
+            .get("blocks", {}).get("write") == "true"]
+
+
+def is_finalized(client, name):
+    """Returns whether writes to partition `name` are blocked."""
+    return bool(finalized(client, [name]))
+
+
+@contextmanager
+def unblocked(client, names):
+    """Context manager that lifts the write block on any finalized
+    indices in `names` while it is open, and finalizes them again (with
+    `finalize_partition()`) when it closes, even if writing failed.
+    Yields the names of the indices that were unblocked."""
+    blocked = finalized(client, names)
+    for name in blocked:
+        client.indices.put_settings(index=name, body={"index.blocks.write": False})
+    try:
+        yield blocked
+    finally:
+        for name in blocked:
+            print(f"Finalizing {name}")
+            finalize_partition(client, name)
+
+
+def finalize_historical(client, before_year=None):
+    """Finalizes every partition for years before `before_year` (default
+    the current year) that hasn't been finalized already. Returns the
+    names of the partitions that were finalized."""
+    if before_year is None:
+        before_year = datetime.now().year
+    finalized = []
+    for year, name in partitions(client):
+        if year >= before_year:
+            continue
+        if is_finalized(client, name):
+            continue
+        print(f"Finalizing {name}")
+        finalize_partition(client, name)
+        finalized.append(name)
+    return finalized
+
+
+if __name__ == "__main__":
+    import os
+    import argparse
+
+    from elasticsearch_dsl import connections
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--template", action="store_true",
+        help="Create or update the index template for partitions")
+    parser.add_argument("--list", action="store_true",
+        help="List partitions and their document counts")
+    parser.add_argument("--finalize", type=int, nargs="?", const=datetime.now().year,
+        help="Force-merge and block writes to partitions before this year (default the current year)")
+    args = parser.parse_args()
+
+    elastic_host = f"{os.getenv('ELASTIC_ADMIN_USER')}:{os.getenv('ELASTIC_ADMIN_PASS')}@{os.getenv('ELASTIC_HOST')}"
+    connections.create_connection(hosts=[elastic_host], timeout=20)
+    client = connections.get_connection()
+
+    if args.template:
+        ensure_template(client)
+    if args.list:
+        for year, name in partitions(client):
+            print(f"{name}\t{client.count(index=name)['count']}")
+    if args.finalize is not None:
+        finalize_historical(client, before_year=args.finalize)
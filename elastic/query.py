@@ -0,0 +1,230 @@
+"""Lightweight querying of preprints from elasticsearch
+
+When imported, this provides a shared, pooled elasticsearch client and
+functions for searching preprints that return only the fields that are
+asked for. Text fields are read from `_source` (with source filtering so
+that e.g. the 256-dim `doc_vector` is never sent over the wire), while
+keyword and date fields are read from doc values. Results are hydrated
+directly from the raw response into `PreprintHit` records, which avoids
+the cost of building full `Preprint` documents. Multiple queries can be
+sent in one round-trip with `msearch_preprints()`, and searches limited
+to a publish date range only query the yearly partitions that cover it.
+
+When run directly as a script, it benchmarks this against hydrating full
+`Preprint` documents from an `elasticsearch_dsl` search (as in
+test_query.py), e.g.:
+
+    python -m elastic.query --sizes 10 100 1000
+"""
+
+import os
+import threading
+
+from elasticsearch import Elasticsearch
+
+from elastic.elastic_mapping import Preprint
+from elastic.partitions import index_for_range
+
+# analyzed text fields have no doc values, so have to come from `_source`
+DEFAULT_SOURCE_FIELDS = ["title", "abstract", "authors"]
+DEFAULT_DOCVALUE_FIELDS = ["source", "source_id", "url", "publish_date",
+                           "categories"]
+
+# fields that can hold more than one value; doc values are always
+# returned as lists, so single-valued fields are unwrapped
+MULTI_VALUED_FIELDS = {"authors", "author_keys", "categories", "keywords"}
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client(maxsize=25, **kwargs):
+    """Returns a shared elasticsearch client, creating it the first time
+    this is called. The client keeps a pool of up to `maxsize`
+    connections open, so it can be used from multiple threads; any other
+    `kwargs` are passed on to `Elasticsearch()` the first time."""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                elastic_host = f"{os.getenv('ELASTIC_ADMIN_USER')}:{os.getenv('ELASTIC_ADMIN_PASS')}@{os.getenv('ELASTIC_HOST')}"
+                _client = Elasticsearch(hosts=[elastic_host], timeout=20,
+                                        maxsize=maxsize, **kwargs)
+    return _client
+
+
+class PreprintHit:
+    """A single search result. Fields that were not requested are None."""
+    __slots__ = ("id", "score", "index", "source", "source_id", "url",
+                 "publish_date", "modified_date", "stored_date", "title",
+                 "abstract", "authors", "author_keys", "categories",
+                 "keywords", "duplicate_cluster")
+
+    def __init__(self, id, score=None, index=None, **fields):
+        self.id = id
+        self.score = score
+        self.index = index  # the concrete index (partition) of the hit
+        for name in self.__slots__[3:]:
+            setattr(self, name, fields.get(name))
+
+    @classmethod
+    def from_hit(cls, hit):
+        """Creates a record from a raw hit in a search response."""
+        fields = hit.get("_source", {})
+        for name, values in hit.get("fields", {}).items():
+            if name in MULTI_VALUED_FIELDS:
+                fields[name] = values
+            else:
+                fields[name] = values[0] if values else None
+        return cls(hit["_id"], hit.get("_score"), hit.get("_index"), **fields)
+
+    def __repr__(self):
+        return f"PreprintHit({self.id}, title={self.title!r})"
+
+
+def build_body(query, size=10, from_=0, source_fields=DEFAULT_SOURCE_FIELDS,
+               docvalue_fields=DEFAULT_DOCVALUE_FIELDS, sort=None,
+               track_total_hits=10000):
+    """Builds a search request body. `query` can be a dict in the
+    elasticsearch query DSL, or an `elasticsearch_dsl` query object (e.g.,
+    `Q("match", title="...")`).
+
+    Total hit counts are only accurate up to `track_total_hits`, which is
+    plenty for paging. Set it to False for queries sorted by
+    `publish_date`, so they can stop early on the sorted index."""
+    if hasattr(query, "to_dict"):
+        query = query.to_dict()
+    body = {
+        "query": query,
+        "size": size,
+        "from": from_,
+        "_source": list(source_fields) if source_fields else False,
+        "track_total_hits": track_total_hits,
+    }
+    if docvalue_fields:
+        body["docvalue_fields"] = list(docvalue_fields)
+    if sort is not None:
+        body["sort"] = sort
+    return body
+
+
+def _parse_response(response):
+    """Returns `(total, hits)` from a raw search response."""
+    total = response["hits"].get("total")  # missing if not tracked
+    if isinstance(total, dict):
+        total = total["value"]
+    return (total, [PreprintHit.from_hit(h) for h in response["hits"]["hits"]])
+
+
+def date_filter(query, published_after=None, published_before=None):
+    """Returns `query` restricted to preprints published between
+    `published_after` and `published_before` (datetimes; either can be
+    None for an open range)."""
+    if published_after is None and published_before is None:
+        return query
+    if hasattr(query, "to_dict"):
+        query = query.to_dict()
+    date_range = {}
+    if published_after is not None:
+        date_range["gte"] = published_after.isoformat()
+    if published_before is not None:
+        date_range["lte"] = published_before.isoformat()
+    return {"bool": {"must": [query],
+                     "filter": [{"range": {"publish_date": date_range}}]}}
+
+
+def search_preprints(query, client=None, index=None, published_after=None,
+                     published_before=None, **kwargs):
+    """Searches for preprints matching `query`. Returns a tuple of the
+    total number of matching preprints and a list of `PreprintHit`s.
+
+    If `published_after` (a datetime) is given, only preprints published
+    since then (and before `published_before`, if given) are searched,
+    and only the yearly partitions that cover that range are queried.
+    Any other `kwargs` are passed on to `build_body()`."""
+    if client is None:
+        client = get_client()
+    if index is None:
+        if published_after is not None:
+            index = index_for_range(client, published_after, published_before)
+        else:
+            index = Preprint._index._name
+    query = date_filter(query, published_after, published_before)
+    response = client.search(index=index, body=build_body(query, **kwargs))
+    return _parse_response(response)
+
+
+def msearch_preprints(queries, client=None, index=None, **kwargs):
+    """Runs several searches in one request. `queries` is a list of
+    queries, or of `(query, options)` tuples, where `options` is a dict of
+    arguments to `build_body()` that override `kwargs` for that query.
+    Returns a list with a `(total, hits)` tuple for each query, in the
+    same order."""
+    if client is None:
+        client = get_client()
+    if index is None:
+        index = Preprint._index._name
+
+    body = []
+    for q in queries:
+        options = kwargs
+        if isinstance(q, tuple):
+            q, overrides = q
+            options = dict(kwargs, **overrides)
+        body.append({"index": index})
+        body.append(build_body(q, **options))
+
+    results = []
+    for response in client.msearch(body=body)["responses"]:
+        if "error" in response:
+            raise RuntimeError(f"Search failed: {response['error']}")
+        results.append(_parse_response(response))
+    return results
+
+
+if __name__ == "__main__":
+    import time
+    import argparse
+    import statistics
+
+    from elasticsearch_dsl import connections
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-q", "--query", default="learning", nargs="?",
+        help="Text to search for in titles and abstracts (default 'learning')")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000],
+        help="Result page sizes to benchmark (default 10 100 1000)")
+    parser.add_argument("-r", "--repeat", type=int, default=20, nargs="?",
+        help="Number of times to run each query (default 20)")
+    args = parser.parse_args()
+
+    connections.add_connection("default", get_client())
+    query = {"multi_match": {"query": args.query, "fields": ["title", "abstract"]}}
+
+    def old_approach(size):
+        response = Preprint.search().query(query)[:size].execute()
+        return [Preprint(meta=h.to_dict(), **h.to_dict()["_source"])
+                for h in response.hits.hits]
+
+    def new_approach(size):
+        return search_preprints(query, size=size)[1]
+
+    def batched_approach(size):
+        # the same page, split into 10 queries sent in one request
+        per_query = max(size // 10, 1)
+        queries = [(query, {"size": per_query, "from_": i * per_query})
+                   for i in range(size // per_query)]
+        return [h for _, hits in msearch_preprints(queries) for h in hits]
+
+    for size in args.sizes:
+        for name, func in [("Preprint", old_approach),
+                           ("PreprintHit", new_approach),
+                           ("msearch x10", batched_approach)]:
+            func(size)  # warm up
+            timings = []
+            for _ in range(args.repeat):
+                start_time = time.perf_counter()
+                func(size)
+                timings.append((time.perf_counter() - start_time) * 1000)
+            print(f"{size:>5} hits  {name:<12}  median {statistics.median(timings):8.2f}ms  "
+                  f"max {max(timings):8.2f}ms")
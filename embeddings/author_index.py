@@ -0,0 +1,217 @@
+"""Local memory-mapped index of authors and their preprints
+
+Maps each normalized author key (see elastic/authors.py) to the
+preprints they wrote, and each preprint back to its authors, so that
+candidates for "more by these authors" and "by their co-authors" can be
+generated in well under a millisecond without a query to elasticsearch.
+Both directions are stored as postings lists in a directory of files:
+
+    keys.npy          sorted author keys (fixed-width bytes)
+    key_offsets.npy   the documents of key i are rows
+    key_docs.npy          key_docs[key_offsets[i]:key_offsets[i + 1]]
+    doc_ids.npy       document ID of each row (fixed-width bytes)
+    doc_offsets.npy   the authors of row j are keys
+    doc_keys.npy          doc_keys[doc_offsets[j]:doc_offsets[j + 1]]
+    sorted_ids.npy    the document IDs, sorted, and the row of each one,
+    sorted_rows.npy       for looking up rows by ID with a binary search
+
+Everything is memory-mapped when the index is opened, so opening it is
+nearly instant and only the postings that are looked up are read.
+
+When run directly as a script, it builds the index from the `author_keys`
+of every preprint in elasticsearch, or benchmarks lookups on an existing
+index, e.g.:
+
+    python embeddings/author_index.py -o data/authors
+    python embeddings/author_index.py -i data/authors --benchmark
+"""
+
+import os
+import sys
+
+import numpy as np
+
+# to allow importing from parent directory
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+from embeddings.embedding_store import search_sorted
+
+
+def _to_bytes(values):
+    return np.array([v.encode() if isinstance(v, str) else v for v in values],
+                    dtype=bytes)
+
+
+def _postings(offsets, values, rows):
+    """Concatenates the postings lists of `rows`."""
+    if len(rows) == 0:
+        return np.empty(0, dtype=values.dtype)
+    return np.concatenate([values[offsets[r]:offsets[r + 1]] for r in rows])
+
+
+def _ranked(items, exclude=(), limit=None):
+    """Returns the unique values of `items` and how many times each one
+    occurs, most frequent first, leaving out those in `exclude`."""
+    values, counts = np.unique(items, return_counts=True)
+    if len(exclude):
+        keep = ~np.isin(values, exclude)
+        values, counts = values[keep], counts[keep]
+    order = np.argsort(-counts, kind="stable")[:limit]
+    return (values[order], counts[order])
+
+
+def write_author_index(documents, path):
+    """Writes a new author index to directory `path`. `documents` is an
+    iterable of `(doc_id, author_keys)` tuples."""
+    os.makedirs(path, exist_ok=True)
+    doc_ids = []
+    doc_keys = []
+    key_rows = {}
+    for doc_id, keys in documents:
+        doc_ids.append(doc_id)
+        doc_keys.append(keys)
+        for key in keys:
+            key_rows.setdefault(key, []).append(len(doc_ids) - 1)
+
+    keys = sorted(key_rows)
+    key_numbers = {k: i for i, k in enumerate(keys)}
+    key_offsets = np.zeros(len(keys) + 1, dtype=np.int64)
+    key_offsets[1:] = np.cumsum([len(key_rows[k]) for k in keys])
+    key_docs = np.fromiter((r for k in keys for r in key_rows[k]),
+                           dtype=np.int32, count=key_offsets[-1])
+    doc_offsets = np.zeros(len(doc_ids) + 1, dtype=np.int64)
+    doc_offsets[1:] = np.cumsum([len(k) for k in doc_keys])
+    doc_key_numbers = np.fromiter((key_numbers[k] for ks in doc_keys for k in ks),
+                                  dtype=np.int32, count=doc_offsets[-1])
+
+    doc_ids = _to_bytes(doc_ids)
+    order = np.argsort(doc_ids, kind="stable")
+    arrays = {
+        "keys": _to_bytes(keys),
+        "key_offsets": key_offsets,
+        "key_docs": key_docs,
+        "doc_ids": doc_ids,
+        "doc_offsets": doc_offsets,
+        "doc_keys": doc_key_numbers,
+        "sorted_ids": doc_ids[order],
+        "sorted_rows": order.astype(np.int64),
+    }
+    for name, array in arrays.items():
+        np.save(os.path.join(path, f"{name}.npy"), array)
+
+
+class AuthorIndex:
+    """Reads an author index written by `write_author_index()`."""
+
+    def __init__(self, path):
+        self.path = path
+
+        def load(name):
+            return np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r")
+
+        self.keys = load("keys")
+        self._key_offsets = load("key_offsets")
+        self._key_docs = load("key_docs")
+        self.doc_ids = load("doc_ids")
+        self._doc_offsets = load("doc_offsets")
+        self._doc_keys = load("doc_keys")
+        self._sorted_ids = load("sorted_ids")
+        self._sorted_rows = load("sorted_rows")
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    def _rows(self, doc_ids):
+        pos = search_sorted(self._sorted_ids, doc_ids)
+        return np.asarray(self._sorted_rows[pos[pos >= 0]])
+
+    def _key_numbers(self, keys):
+        pos = search_sorted(self.keys, keys)
+        return pos[pos >= 0]
+
+    def authors(self, doc_id):
+        """Returns the author keys of the document with ID `doc_id`, or
+        an empty list if it isn't in the index."""
+        numbers = _postings(self._doc_offsets, self._doc_keys, self._rows([doc_id]))
+        return [k.decode() for k in self.keys[numbers]]
+
+    def documents(self, keys, limit=None):
+        """Returns `(doc_ids, counts)` of documents by any of the authors
+        in `keys`, and how many of them each one is by, most first."""
+        rows = _postings(self._key_offsets, self._key_docs, self._key_numbers(keys))
+        rows, counts = _ranked(rows, limit=limit)
+        return (self.doc_ids[rows], counts)
+
+    def same_author(self, doc_id, limit=None):
+        """Returns `(doc_ids, counts)` of other documents that share
+        authors with the document with ID `doc_id`, and how many authors
+        each one shares, most first."""
+        doc_rows = self._rows([doc_id])
+        numbers = _postings(self._doc_offsets, self._doc_keys, doc_rows)
+        rows = _postings(self._key_offsets, self._key_docs, numbers)
+        rows, counts = _ranked(rows, exclude=doc_rows, limit=limit)
+        return (self.doc_ids[rows], counts)
+
+    def coauthors(self, key, limit=None):
+        """Returns `(keys, counts)` of the co-authors of author `key`, and
+        how many documents they wrote together, most first."""
+        numbers = self._key_numbers([key])
+        rows = _postings(self._key_offsets, self._key_docs, numbers)
+        coauthors = _postings(self._doc_offsets, self._doc_keys, rows)
+        coauthors, counts = _ranked(coauthors, exclude=numbers, limit=limit)
+        return ([k.decode() for k in self.keys[coauthors]], counts)
+
+
+if __name__ == "__main__":
+    import time
+    import argparse
+
+    from elasticsearch_dsl import connections
+
+    from elastic.authors import author_keys
+    from elastic.corpus_export import export_corpus
+
+    parser = argparse.ArgumentParser()
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument("-o", "--outfile", nargs="?",
+        help="Directory to build the index in")
+    group.add_argument("-i", "--index", nargs="?",
+        help="Directory of an existing index to benchmark")
+    parser.add_argument("-q", "--queries", type=int, default=1000, nargs="?",
+        help="Number of random documents to benchmark lookups with (default 1000)")
+    args = parser.parse_args()
+
+    if args.outfile:
+        elastic_host = f"{os.getenv('ELASTIC_ADMIN_USER')}:{os.getenv('ELASTIC_ADMIN_PASS')}@{os.getenv('ELASTIC_HOST')}"
+        connections.create_connection(hosts=[elastic_host], timeout=20)
+
+        def documents():
+            for doc in export_corpus(fields=["authors", "author_keys"], ordered=False):
+                keys = doc.author_keys
+                if not keys:
+                    # not backfilled yet (see elastic/authors.py); the
+                    # export fills in missing fields with empty lists
+                    keys = author_keys(doc.authors or [])
+                yield (doc._id, list(keys))
+
+        start_time = time.time()
+        write_author_index(documents(), args.outfile)
+        index = AuthorIndex(args.outfile)
+        print(f"Indexed {len(index.keys)} authors of {len(index)} preprints "
+              f"in {time.time() - start_time:.1f}s")
+    else:
+        index = AuthorIndex(args.index)
+
+    rng = np.random.default_rng(42)
+    doc_ids = index.doc_ids[rng.choice(len(index), min(args.queries, len(index)), replace=False)]
+    start_time = time.perf_counter()
+    for doc_id in doc_ids:
+        index.same_author(doc_id)
+    elapsed = time.perf_counter() - start_time
+    print(f"same_author: {elapsed / len(doc_ids) * 1000:.3f}ms per lookup")
+
+    keys = [a for d in doc_ids for a in index.authors(d)][:len(doc_ids)]
+    start_time = time.perf_counter()
+    for key in keys:
+        index.coauthors(key)
+    elapsed = time.perf_counter() - start_time
+    print(f"coauthors: {elapsed / max(len(keys), 1) * 1000:.3f}ms per lookup")
@@ -0,0 +1,181 @@
+"""Generates the daily feed for every user in one batch
+
+Rather than querying for each user's recommendations separately, this
+takes all the preprints stored in the database on a given day, embeds
+them with the saved TF-IDF model, and scores them against every user's
+profile vector with matrix multiplies, a block of users at a time. A
+running top-k of preprints is kept for each user in the block (as
+arrays, so that a whole block is updated at once rather than one heap
+per user), and each block's feeds are written out before moving on to
+the next one.
+
+User profiles are read from an `EmbeddingStore` (see embedding_store.py)
+keyed by user ID, with vectors in the same space as the TF-IDF model.
+Since the store is memory-mapped and feeds are written as each block is
+finished, only one block of users needs to be in memory at a time, so
+this works for any number of users. Profiles are as wide as the TF-IDF
+vocabulary, which can have hundreds of thousands of terms, so the
+number of users in a block is worked out from a memory limit and the
+number of dimensions. Feeds are written as JSON lines,
+one user per line:
+
+    {"user": "...", "preprints": [{"id": "...", "score": 0.42}, ...]}
+
+Run as a script, e.g.:
+
+    python embeddings/daily_feeds.py -p data/profiles --date 2020-10-14
+"""
+
+import json
+import time
+
+import numpy as np
+
+
+def top_k_merge(best_scores, best_ids, scores, ids, k):
+    """Merges new candidates into a running top-k for a block of users.
+    `best_scores` and `best_ids` are (users, <=k) arrays of the current
+    top-k; `scores` is a (users, candidates) array of new scores for the
+    documents in `ids`. Returns the updated `(best_scores, best_ids)`,
+    sorted best first."""
+    all_scores = np.concatenate([best_scores, scores], axis=1)
+    all_ids = np.concatenate(
+        [best_ids, np.broadcast_to(ids, scores.shape)], axis=1)
+    k = min(k, all_scores.shape[1])
+    top = np.argpartition(-all_scores, k - 1, axis=1)[:, :k]
+    top_scores = np.take_along_axis(all_scores, top, axis=1)
+    order = np.argsort(-top_scores, axis=1, kind="stable")
+    return (np.take_along_axis(top_scores, order, axis=1),
+            np.take_along_axis(np.take_along_axis(all_ids, top, axis=1),
+                               order, axis=1))
+
+
+def users_per_block(dims, doc_block, k, max_bytes):
+    """Returns how many users can be scored at a time in about
+    `max_bytes` of memory, with `dims`-dimensional profiles and
+    `doc_block` documents at a time."""
+    # each user has a float32 profile, a float32 row of scores for a
+    # block of documents, and the scores, int64 rows and positions
+    # that `top_k_merge()` builds from them
+    per_user = 4 * dims + 4 * doc_block + 20 * (doc_block + k)
+    return max(1, max_bytes // per_user)
+
+
+def generate_feeds(doc_vectors, doc_ids, profiles, outfile, k=20,
+                   user_block=None, doc_block=8192, min_score=0.0,
+                   max_bytes=512 * 1024 * 1024):
+    """Scores every document against every user profile and writes each
+    user's top `k` documents to `outfile` (an open text file).
+
+    `doc_vectors` is a (documents, dims) dense or scipy sparse array with
+    L2-normalized rows (as produced by `TfidfVectorizer`), `doc_ids` the
+    document ID of each row, and `profiles` an `EmbeddingStore` of user
+    profile vectors. Users are processed `user_block` at a time (by
+    default, as many as fit in about `max_bytes`; see
+    `users_per_block()`), and documents `doc_block` at a time within
+    each block of users. Documents
+    scoring `min_score` or lower are left out of feeds. Returns the
+    number of users written.
+    """
+    doc_ids = np.asarray(doc_ids)
+    n_docs = doc_vectors.shape[0]
+    n_users = len(profiles)
+    if user_block is None:
+        user_block = users_per_block(profiles.dims, doc_block, k, max_bytes)
+    for start in range(0, n_users, user_block):
+        end = min(start + user_block, n_users)
+        users = profiles.get(np.arange(start, end))
+
+        best_scores = np.empty((end - start, 0), dtype=np.float32)
+        best_rows = np.empty((end - start, 0), dtype=np.int64)
+        for doc_start in range(0, n_docs, doc_block):
+            doc_end = min(doc_start + doc_block, n_docs)
+            # (docs x dims) @ (dims x users) works whether or not the
+            # documents are sparse, and gives a dense result
+            scores = np.asarray(doc_vectors[doc_start:doc_end] @ users.T,
+                                dtype=np.float32).T
+            best_scores, best_rows = top_k_merge(
+                best_scores, best_rows, scores,
+                np.arange(doc_start, doc_end), k)
+
+        user_ids = profiles.ids[start:end]
+        for user_id, scores, rows in zip(user_ids, best_scores, best_rows):
+            keep = scores > min_score
+            feed = [{"id": str(doc_ids[r]), "score": round(float(s), 4)}
+                    for r, s in zip(rows[keep], scores[keep])]
+            outfile.write(json.dumps({"user": user_id.decode(), "preprints": feed}) + "\n")
+    return n_users
+
+
+if __name__ == "__main__":
+    import os
+    import sys
+    import pickle
+    import argparse
+    from datetime import datetime, timedelta
+
+    from elasticsearch_dsl import connections
+
+    # to allow importing from parent directory
+    sys.path.insert(1, os.path.join(sys.path[0], '..'))
+    from elastic.corpus_export import export_corpus
+    from embeddings.embedding_store import EmbeddingStore
+    from tf_idf import tokenizer, time_elapsed
+
+    # the model was pickled by tf_idf.py running as a script, so it
+    # refers to its tokenizer as `__main__.tokenizer`
+    import __main__
+    __main__.tokenizer = tokenizer
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-m", "--modelfile", default="tf_idf_model.pkl", nargs="?",
+        help="Filename of trained TF-IDF model (default tf_idf_model.pkl)")
+    parser.add_argument("-p", "--profiles", default="data/profiles", nargs="?",
+        help="Directory of the embedding store of user profiles (default data/profiles)")
+    parser.add_argument("-o", "--outfile", default="daily_feeds.jsonl", nargs="?",
+        help="Filename where feeds will be saved (default daily_feeds.jsonl)")
+    parser.add_argument("-d", "--date", nargs="?",
+        help="Generate feeds from preprints stored on this date, in YYYY-MM-DD format (default today)")
+    parser.add_argument("-k", type=int, default=20, nargs="?",
+        help="Number of preprints in each user's feed (default 20)")
+    parser.add_argument("--user_block", type=int, nargs="?",
+        help="Number of users to score at a time (default as many as fit in --memory)")
+    parser.add_argument("--memory", type=int, default=512, nargs="?",
+        help="Approximate memory to use for each block of users, in MB (default 512)")
+    args = parser.parse_args()
+
+    elastic_host = f"{os.getenv('ELASTIC_ADMIN_USER')}:{os.getenv('ELASTIC_ADMIN_PASS')}@{os.getenv('ELASTIC_HOST')}"
+    connections.create_connection(hosts=[elastic_host], timeout=20)
+
+    day = datetime.strptime(args.date, "%Y-%m-%d") if args.date else datetime.now()
+    day = day.replace(hour=0, minute=0, second=0, microsecond=0)
+    query = {"range": {"stored_date": {"gte": day.isoformat(),
+                                       "lt": (day + timedelta(days=1)).isoformat()}}}
+
+    with open(args.modelfile, "rb") as f:
+        model = pickle.load(f)
+    profiles = EmbeddingStore(args.profiles)
+
+    print("Gathering new preprints...")
+    start_time = time.time()
+    docs = list(export_corpus(query=query, fields=["abstract"], ordered=False))
+    print(f"Completed in {time_elapsed(time.time() - start_time)}")
+    print(f"New preprints: {len(docs)}")
+    if not docs:
+        sys.exit("No new preprints to recommend.")
+
+    print("Creating embeddings...")
+    start_time = time.time()
+    doc_vectors = model.transform(docs)
+    print(f"Completed in {time_elapsed(time.time() - start_time)}")
+    if doc_vectors.shape[1] != profiles.dims:
+        sys.exit(f"Error: Model has {doc_vectors.shape[1]} dimensions but profiles have {profiles.dims}.")
+
+    print(f"Scoring against {len(profiles)} users...")
+    start_time = time.time()
+    with open(args.outfile, "w") as f:
+        n = generate_feeds(doc_vectors, [d._id for d in docs], profiles, f,
+                           k=args.k, user_block=args.user_block,
+                           max_bytes=args.memory * 1024 * 1024)
+    elapsed = time.time() - start_time
+    print(f"Completed in {time_elapsed(elapsed)} ({n / elapsed:.0f} users/s)")
@@ -0,0 +1,357 @@
+"""Finds near-duplicate preprints across sources
+
+Many papers are posted to both arXiv and an OSF provider (e.g.,
+PsyArXiv), and so get loaded twice. Comparing every pair of preprints is
+far too slow, so this uses MinHash with locality-sensitive hashing
+(LSH): each preprint's title and abstract are tokenized (with the same
+`tokenize()` used for TF-IDF) and broken into shingles of
+`SHINGLE_SIZE` consecutive tokens, and a MinHash signature of
+`NUM_PERM` values is computed from the shingles. The fraction of values
+two signatures share estimates the Jaccard similarity of their shingle
+sets. Signatures are split into `BANDS` bands; only preprints that match
+exactly on at least one band are compared, and those whose estimated
+similarity is at least `THRESHOLD` are counted as duplicates.
+
+Each preprint's band hashes are stored in its `minhash_bands` field, so
+that new preprints can be checked against the existing ones with a
+single query, which ranks them by how many bands they share; each
+preprint gets a `duplicate_cluster` ID, which is the ID of the earliest
+preprint it duplicates (or its own ID).
+
+Run as a script, either over the whole corpus, or incrementally over
+preprints stored since a given date, e.g.:
+
+    python embeddings/dedup.py --full
+    python embeddings/dedup.py --since 2020-10-14
+
+With `--evaluate`, precision and recall are reported against a
+tab-separated file of labelled pairs (`id_a  id_b  is_duplicate`).
+"""
+
+import os
+import sys
+import zlib
+
+import numpy as np
+from elasticsearch.helpers import bulk
+
+# to allow importing from parent directory
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+from embeddings.tf_idf import tokenize
+from elastic.partitions import unblocked
+from elastic.query import msearch_preprints
+
+SHINGLE_SIZE = 3
+NUM_PERM = 120
+BANDS = 20
+THRESHOLD = 0.7
+
+# buckets bigger than this are usually boilerplate text shared by many
+# preprints, so only neighbouring members of them are compared
+MAX_BUCKET = 100
+
+# hash functions are (a * x + b) mod p; these have to be the same on
+# every run, or signatures stored earlier can't be compared
+_PRIME = np.uint64(4294967311)  # the smallest prime above 2**32
+_rng = np.random.RandomState(1)
+_A = _rng.randint(1, 2**32 - 1, size=NUM_PERM, dtype=np.uint64)
+_B = _rng.randint(0, 2**32 - 1, size=NUM_PERM, dtype=np.uint64)
+# bands are hashed by multiplying each value by one of these and summing
+# (wrapping around at 64 bits)
+_BAND_MULT = _rng.randint(1, 2**63 - 1, size=NUM_PERM // BANDS, dtype=np.uint64) | np.uint64(1)
+
+
+def shingles(text):
+    """Returns the set of shingles (runs of `SHINGLE_SIZE` tokens) in
+    `text`."""
+    tokens = tokenize(text)
+    if len(tokens) < SHINGLE_SIZE:
+        return {" ".join(tokens)} if tokens else set()
+    return {" ".join(tokens[i:i + SHINGLE_SIZE])
+            for i in range(len(tokens) - SHINGLE_SIZE + 1)}
+
+
+def minhash(text):
+    """Returns the MinHash signature of `text` as an array of `NUM_PERM`
+    values, or None if the text has no tokens."""
+    sh = shingles(text)
+    if not sh:
+        return None
+    # crc32 rather than hash(), which is randomized for each process
+    hashes = np.fromiter((zlib.crc32(s.encode()) for s in sh),
+                         dtype=np.uint64, count=len(sh))
+    # a * x fits in 64 bits since both are less than 2**32; the result is
+    # stored in 32 bits to halve memory use, which only merges the top
+    # 15 of the (p - 1) possible values
+    values = ((hashes[:, None] * _A + _B) % _PRIME).min(axis=0)
+    return np.minimum(values, 2**32 - 1).astype(np.uint32)
+
+
+def document_text(doc):
+    """Returns the text of a document that is compared for duplicates."""
+    return f"{getattr(doc, 'title', None) or ''} {getattr(doc, 'abstract', None) or ''}"
+
+
+def band_hashes(signatures):
+    """Returns a (documents, `BANDS`) array with a hash of each band of
+    each signature in the (documents, `NUM_PERM`) array `signatures`."""
+    rows = NUM_PERM // BANDS
+    bands = signatures[:, :rows * BANDS].reshape(len(signatures), BANDS, rows)
+    return (bands * _BAND_MULT).sum(axis=2, dtype=np.uint64)
+
+
+def band_keys(band_hash_row):
+    """Returns the `minhash_bands` keywords for one document's band
+    hashes. These include the band number, since only the same band of
+    two signatures should be compared."""
+    return [f"{b}-{h:x}" for b, h in enumerate(band_hash_row)]
+
+
+def similarity(sig_a, sig_b):
+    """Estimates the Jaccard similarity of two signatures."""
+    return float(np.mean(sig_a == sig_b))
+
+
+class _UnionFind:
+    """Union-find where the root of each set is its smallest member."""
+
+    def __init__(self, n):
+        self.parent = list(range(n))
+
+    def find(self, i):
+        while self.parent[i] != i:
+            self.parent[i] = self.parent[self.parent[i]]
+            i = self.parent[i]
+        return i
+
+    def union(self, i, j):
+        i, j = self.find(i), self.find(j)
+        if i != j:
+            self.parent[max(i, j)] = min(i, j)
+
+
+def find_clusters(signatures, threshold=THRESHOLD):
+    """Finds clusters of near-duplicates among `signatures`, a
+    (documents, `NUM_PERM`) array. Returns an array with the cluster of
+    each document, which is the row of the first document in the
+    cluster (so documents should be in order of publish date)."""
+    n = len(signatures)
+    uf = _UnionFind(n)
+    hashes = band_hashes(signatures)
+    for b in range(BANDS):
+        order = np.argsort(hashes[:, b], kind="stable")
+        sorted_hashes = hashes[order, b]
+        boundaries = np.flatnonzero(np.diff(sorted_hashes)) + 1
+        for bucket in np.split(order, boundaries):
+            if len(bucket) < 2:
+                continue
+            bucket = np.sort(bucket)
+            if len(bucket) > MAX_BUCKET:
+                pairs = zip(bucket[:-1], bucket[1:])
+            else:
+                pairs = ((bucket[i], bucket[j]) for i in range(len(bucket))
+                         for j in range(i + 1, len(bucket)))
+            for i, j in pairs:
+                if uf.find(i) != uf.find(j) and similarity(signatures[i], signatures[j]) >= threshold:
+                    uf.union(i, j)
+    return np.array([uf.find(i) for i in range(n)], dtype=np.int64)
+
+
+def _signatures(docs):
+    """Returns the IDs and indices of the documents in `docs` that have
+    any text, and an array of their signatures. Only these are kept, not
+    the documents themselves, so their text can be freed as it goes."""
+    signatures = []
+    ids = []
+    indices = []
+    for doc in docs:
+        sig = minhash(document_text(doc))
+        if sig is not None:
+            signatures.append(sig)
+            ids.append(doc._id)
+            indices.append(doc._index)
+    return (ids, indices, np.array(signatures, dtype=np.uint32).reshape(-1, NUM_PERM))
+
+
+def _cluster_updates(ids, indices, signatures, threshold):
+    """Returns `(index, id, fields)` updates for clusters found among the
+    documents with the given `ids`, `indices` and `signatures`."""
+    clusters = find_clusters(signatures, threshold)
+    hashes = band_hashes(signatures)
+    return [(indices[i], doc_id, {"minhash_bands": band_keys(hashes[i]),
+                                  "duplicate_cluster": ids[clusters[i]]})
+            for i, doc_id in enumerate(ids)]
+
+
+def _band_query(keys):
+    """Returns a query for preprints that share any of the band `keys`,
+    scored by how many of them they share, so that preprints that are
+    likely duplicates come before ones that only share a common band
+    (e.g., of boilerplate text)."""
+    return {"bool": {
+        # each matching band adds 1 to the score
+        "should": [{"constant_score": {"filter": {"term": {"minhash_bands": k}}}}
+                   for k in keys],
+        "minimum_should_match": 1,
+    }}
+
+
+def dedup_full(docs, threshold=THRESHOLD):
+    """Finds duplicates among all of `docs` (which should be in order of
+    publish date, with `_id`, `_index`, `title`, and `abstract`). Returns
+    a list of `(index, id, fields)` updates to write back."""
+    ids, indices, signatures = _signatures(docs)
+    if not ids:
+        return []
+    return _cluster_updates(ids, indices, signatures, threshold)
+
+
+def dedup_new(client, docs, index=None, threshold=THRESHOLD, batch_size=100):
+    """Checks newly loaded `docs` (in order of publish date, with `_id`,
+    `_index`, `title`, and `abstract`) for duplicates, both among
+    themselves and against preprints that have already been
+    deduplicated, by searching for preprints that share a band hash.
+    Returns a list of `(index, id, fields)` updates to write back, which
+    can include existing preprints that weren't in a cluster yet."""
+    ids, indices, signatures = _signatures(docs)
+    if not ids:
+        return []
+    updates = _cluster_updates(ids, indices, signatures, threshold)
+    new_ids = set(ids)
+
+    # clusters within the new batch, which may be merged into existing
+    # clusters below
+    batch_cluster = {doc_id: fields["duplicate_cluster"] for _, doc_id, fields in updates}
+    existing_cluster = {}
+    existing_updates = {}
+    for start in range(0, len(updates), batch_size):
+        batch = updates[start:start + batch_size]
+        queries = [_band_query(fields["minhash_bands"]) for _, _, fields in batch]
+        results = msearch_preprints(
+            queries, client=client, index=index, size=20,
+            source_fields=["title", "abstract"],
+            docvalue_fields=["duplicate_cluster", "publish_date"],
+            sort=["_score", {"publish_date": "asc"}], track_total_hits=False)
+        for i, (_, hits) in enumerate(results):
+            doc_id = batch[i][1]
+            matches = []
+            for hit in hits:
+                if hit.id in new_ids:
+                    continue
+                candidate = minhash(document_text(hit))
+                if candidate is not None and similarity(signatures[start + i], candidate) >= threshold:
+                    matches.append((hit, candidate))
+            if not matches:
+                continue
+            # the earliest matching preprint; publish dates are ISO
+            # format strings, so they sort in date order
+            hit, candidate = min(matches, key=lambda m: m[0].publish_date or "")
+            existing_cluster.setdefault(batch_cluster[doc_id],
+                                        hit.duplicate_cluster or hit.id)
+            if hit.duplicate_cluster is None:
+                existing_updates[hit.id] = (hit, candidate)
+
+    for _, doc_id, fields in updates:
+        fields["duplicate_cluster"] = existing_cluster.get(batch_cluster[doc_id],
+                                                           batch_cluster[doc_id])
+    for hit, sig in existing_updates.values():
+        hashes = band_hashes(sig[None, :])[0]
+        updates.append((hit.index, hit.id, {"minhash_bands": band_keys(hashes),
+                                            "duplicate_cluster": hit.id}))
+    return updates
+
+
+def write_updates(client, updates):
+    """Writes `(index, id, fields)` updates to elasticsearch. Finalized
+    partitions are unblocked while writing and finalized again after."""
+    actions = ({"_op_type": "update", "_index": index, "_id": doc_id, "doc": fields}
+               for index, doc_id, fields in updates)
+    with unblocked(client, {index for index, _, _ in updates}):
+        bulk(client, actions, chunk_size=1000, refresh=True)
+
+
+def evaluate(clusters, labels):
+    """Returns `(precision, recall)` of duplicate clusters (a dict of
+    ID -> cluster ID) against `labels`, a list of `(id_a, id_b,
+    is_duplicate)` tuples."""
+    tp = fp = fn = 0
+    for a, b, is_duplicate in labels:
+        predicted = a in clusters and clusters.get(a) == clusters.get(b)
+        if predicted and is_duplicate:
+            tp += 1
+        elif predicted:
+            fp += 1
+        elif is_duplicate:
+            fn += 1
+    precision = tp / (tp + fp) if tp + fp > 0 else float("nan")
+    recall = tp / (tp + fn) if tp + fn > 0 else float("nan")
+    return (precision, recall)
+
+
+if __name__ == "__main__":
+    import time
+    import argparse
+    from datetime import datetime
+
+    from elasticsearch_dsl import connections
+
+    from elastic.corpus_export import export_corpus
+    from elastic.query import search_preprints
+
+    parser = argparse.ArgumentParser()
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument("--full", action="store_true",
+        help="Find duplicates across the whole corpus")
+    group.add_argument("--since", nargs="?",
+        help="Check preprints stored on or after this date (YYYY-MM-DD) against the rest")
+    parser.add_argument("--evaluate", nargs="?",
+        help="Tab-separated file of labelled pairs (id_a, id_b, is_duplicate) to report precision and recall on")
+    parser.add_argument("--threshold", type=float, default=THRESHOLD, nargs="?",
+        help=f"Minimum estimated Jaccard similarity of duplicates (default {THRESHOLD})")
+    parser.add_argument("--dry_run", action="store_true",
+        help="Don't write clusters back to the database")
+    args = parser.parse_args()
+
+    elastic_host = f"{os.getenv('ELASTIC_ADMIN_USER')}:{os.getenv('ELASTIC_ADMIN_PASS')}@{os.getenv('ELASTIC_HOST')}"
+    connections.create_connection(hosts=[elastic_host], timeout=20)
+    client = connections.get_connection()
+
+    query = None
+    if args.since:
+        since = datetime.strptime(args.since, "%Y-%m-%d")
+        query = {"range": {"stored_date": {"gte": since.isoformat()}}}
+    docs = export_corpus(query=query, fields=["title", "abstract", "publish_date"])
+
+    start_time = time.time()
+    if args.full:
+        updates = dedup_full(docs, args.threshold)
+    else:
+        updates = dedup_new(client, list(docs), threshold=args.threshold)
+    elapsed = time.time() - start_time
+    print(f"Processed {len(updates)} preprints in {elapsed:.1f}s ({len(updates) / elapsed:.0f} docs/s)")
+
+    clusters = {doc_id: fields["duplicate_cluster"] for _, doc_id, fields in updates}
+    sizes = {}
+    for c in clusters.values():
+        sizes[c] = sizes.get(c, 0) + 1
+    print(f"Duplicate clusters: {sum(1 for s in sizes.values() if s > 1)}")
+
+    if not args.dry_run:
+        write_updates(client, updates)
+
+    if args.evaluate:
+        with open(args.evaluate, "r") as f:
+            labels = []
+            for line in f:
+                a, b, is_duplicate = line.rstrip("\n").split("\t")
+                labels.append((a, b, is_duplicate.strip().lower() in ("1", "true", "yes")))
+        # fill in clusters of labelled preprints that weren't processed
+        missing = list({i for a, b, _ in labels for i in (a, b)} - set(clusters))
+        for start in range(0, len(missing), 1000):
+            _, hits = search_preprints({"ids": {"values": missing[start:start + 1000]}},
+                                       size=1000, source_fields=None,
+                                       docvalue_fields=["duplicate_cluster"])
+            clusters.update({h.id: h.duplicate_cluster for h in hits if h.duplicate_cluster})
+        precision, recall = evaluate(clusters, labels)
+        print(f"Precision: {precision:.3f}")
+        print(f"Recall: {recall:.3f}")
@@ -0,0 +1,254 @@
+"""Local memory-mapped store of document embeddings
+
+Stores one embedding vector per document on disk, keyed by the
+elasticsearch document ID, as a directory of files:
+
+    vectors.npy     (n, dims) array of vectors, L2-normalized so that a
+                    dot product is a cosine similarity
+    scales.npy      for int8 stores only, the scale of each vector
+    ids.npy         document ID of each row (fixed-width bytes)
+    sorted_ids.npy  the same IDs, sorted, and the row of each one, for
+    sorted_rows.npy     looking up rows by ID with a binary search
+    meta.json       the data type the vectors are stored as
+
+Vectors can be stored as float32, float16 (half the size, with almost
+no loss of precision for normalized vectors), or int8 with a float32
+scale per vector (a quarter of the size). For int8, each vector is
+divided by its largest absolute value and multiplied by 127 before
+rounding, so `vector ~= int8_vector * scale`. Scoring works directly on
+the stored data a block at a time, so the full-precision vectors never
+need to be in memory at once.
+
+Everything is memory-mapped when the store is opened, so opening it is
+nearly instant, and looking up a batch of IDs does not require building
+an in-memory dict of millions of IDs.
+
+When run directly as a script, it benchmarks the recall and scoring
+throughput of each data type against float32, e.g.:
+
+    python embeddings/embedding_store.py --synthetic 1000000
+"""
+
+import os
+import json
+
+import numpy as np
+
+DTYPES = ("float32", "float16", "int8")
+
+
+def normalize(vectors):
+    """L2-normalizes each row of `vectors`; rows of all zeros are left
+    as-is."""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+
+def quantize_int8(vectors):
+    """Returns `(int8 vectors, scales)` for a float array, with one scale
+    per row."""
+    scales = np.abs(vectors).max(axis=1) / 127
+    scales[scales == 0] = 1
+    quantized = np.rint(vectors / scales[:, None]).astype(np.int8)
+    return (quantized, scales.astype(np.float32))
+
+
+def search_sorted(sorted_values, values):
+    """Returns the position of each of `values` (strings or bytes) in
+    `sorted_values`, a sorted array of fixed-width bytes, or -1 for
+    values that are not in it."""
+    if len(sorted_values) == 0:
+        return np.full(len(values), -1, dtype=np.int64)
+    values = [v.encode() if isinstance(v, str) else v for v in values]
+    width = sorted_values.dtype.itemsize
+    # values longer than the stored width would be truncated when
+    # converted, and can't be in the array anyway
+    fits = np.array([len(v) <= width for v in values], dtype=bool)
+    keys = np.array(values, dtype=sorted_values.dtype)
+    pos = np.searchsorted(sorted_values, keys)
+    pos = np.minimum(pos, len(sorted_values) - 1)
+    found = (sorted_values[pos] == keys) & fits
+    return np.where(found, pos, -1)
+
+
+def write_embedding_store(path, ids, vectors, dtype="float32", block=10000):
+    """Writes a new embedding store to directory `path`. `ids` is a list
+    of document IDs and `vectors` is an array with one row per ID. Dense
+    or scipy sparse arrays are accepted (e.g., the output of a fitted
+    `TfidfVectorizer`); vectors are normalized and converted to `dtype`
+    (one of `DTYPES`) in blocks of `block` rows."""
+    if dtype not in DTYPES:
+        raise ValueError(f"dtype must be one of {DTYPES}, not {dtype!r}")
+    os.makedirs(path, exist_ok=True)
+    ids = np.array([i.encode() if isinstance(i, str) else i for i in ids],
+                   dtype=bytes)
+    n, dims = vectors.shape
+    if len(ids) != n:
+        raise ValueError(f"Got {len(ids)} IDs but {n} vectors")
+
+    out = np.lib.format.open_memmap(os.path.join(path, "vectors.npy"),
+                                    mode="w+", dtype=dtype, shape=(n, dims))
+    if dtype == "int8":
+        scales = np.lib.format.open_memmap(os.path.join(path, "scales.npy"),
+                                           mode="w+", dtype=np.float32,
+                                           shape=(n,))
+    for start in range(0, n, block):
+        chunk = vectors[start:start + block]
+        if hasattr(chunk, "toarray"):
+            chunk = chunk.toarray()
+        chunk = normalize(chunk)
+        if dtype == "int8":
+            out[start:start + block], scales[start:start + block] = quantize_int8(chunk)
+        else:
+            out[start:start + block] = chunk
+    out.flush()
+    del out
+    if dtype == "int8":
+        scales.flush()
+        del scales
+
+    order = np.argsort(ids, kind="stable")
+    np.save(os.path.join(path, "ids.npy"), ids)
+    np.save(os.path.join(path, "sorted_ids.npy"), ids[order])
+    np.save(os.path.join(path, "sorted_rows.npy"), order.astype(np.int64))
+    with open(os.path.join(path, "meta.json"), "w") as f:
+        json.dump({"dtype": dtype}, f)
+
+
+class EmbeddingStore:
+    """Reads an embedding store written by `write_embedding_store()`."""
+
+    def __init__(self, path):
+        self.path = path
+
+        def load(name):
+            return np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r")
+
+        meta_file = os.path.join(path, "meta.json")
+        if os.path.exists(meta_file):
+            with open(meta_file, "r") as f:
+                self.dtype = json.load(f)["dtype"]
+        else:  # stores written before quantization was added
+            self.dtype = "float32"
+
+        self.vectors = load("vectors")
+        self.scales = load("scales") if self.dtype == "int8" else None
+        self.ids = load("ids")
+        self._sorted_ids = load("sorted_ids")
+        self._sorted_rows = load("sorted_rows")
+
+    def __len__(self):
+        return self.vectors.shape[0]
+
+    @property
+    def dims(self):
+        return self.vectors.shape[1]
+
+    def lookup(self, ids):
+        """Returns an array with the row of each ID in `ids`, or -1 for
+        IDs that are not in the store."""
+        pos = search_sorted(self._sorted_ids, ids)
+        if len(self) == 0:
+            return pos
+        return np.where(pos >= 0, self._sorted_rows[np.maximum(pos, 0)], -1)
+
+    def get(self, rows):
+        """Returns the vectors at `rows` as a float32 array."""
+        rows = np.asarray(rows)
+        vectors = np.asarray(self.vectors[rows], dtype=np.float32)
+        if self.scales is not None:
+            vectors *= self.scales[rows][:, None]
+        return vectors
+
+    def _score_block(self, block, scales, query):
+        """Scores a block of stored vectors against float32 `query`."""
+        scores = block.astype(np.float32) @ query.T
+        if scales is not None:
+            # scaling the scores is the same as scaling the vectors, but
+            # touches far fewer values
+            scores *= scales.reshape((-1,) + (1,) * (scores.ndim - 1))
+        return scores
+
+    def score(self, query, rows):
+        """Returns the dot product of `query` (a single vector, or an
+        array with one vector per row) with the vectors at `rows`."""
+        rows = np.asarray(rows)
+        scales = self.scales[rows] if self.scales is not None else None
+        return self._score_block(self.vectors[rows], scales,
+                                 np.asarray(query, dtype=np.float32))
+
+    def score_all(self, query, block=65536):
+        """Returns the dot product of `query` with every vector in the
+        store, reading the store `block` rows at a time."""
+        query = np.asarray(query, dtype=np.float32)
+        shape = (len(self),) + query.shape[:-1]
+        scores = np.empty(shape, dtype=np.float32)
+        for start in range(0, len(self), block):
+            end = min(start + block, len(self))
+            scales = self.scales[start:end] if self.scales is not None else None
+            scores[start:end] = self._score_block(self.vectors[start:end],
+                                                  scales, query)
+        return scores
+
+    def top_k(self, query, k=10, block=65536):
+        """Returns `(rows, scores)` of the `k` vectors with the highest dot
+        product with `query` (a single vector), best first."""
+        scores = self.score_all(query, block=block)
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return (top, scores[top])
+
+
+if __name__ == "__main__":
+    import time
+    import tempfile
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-e", "--embeddings", nargs="?",
+        help="Directory of an existing float32 embedding store to benchmark with")
+    parser.add_argument("--synthetic", type=int, default=200000, nargs="?",
+        help="If no store is given, number of random vectors to generate (default 200000)")
+    parser.add_argument("--dims", type=int, default=256, nargs="?",
+        help="Dimensions of random vectors (default 256)")
+    parser.add_argument("-q", "--queries", type=int, default=50, nargs="?",
+        help="Number of queries to measure recall with (default 50)")
+    parser.add_argument("-k", type=int, default=10, nargs="?",
+        help="Number of top results to measure recall of (default 10)")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(42)
+    if args.embeddings:
+        source = EmbeddingStore(args.embeddings)
+        ids = [i.decode() for i in source.ids]
+        vectors = source.vectors
+    else:
+        # clustered random vectors, which look more like real embeddings
+        # than uniform noise does
+        centers = rng.standard_normal((100, args.dims))
+        vectors = (centers[rng.integers(0, 100, args.synthetic)]
+                   + rng.standard_normal((args.synthetic, args.dims)))
+        ids = [str(i) for i in range(args.synthetic)]
+    queries = normalize(vectors[rng.choice(len(ids), args.queries, replace=False)])
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        truth = None
+        print("dtype    size (MB)  queries/s  vectors/s  recall@k")
+        for dtype in DTYPES:
+            path = os.path.join(tmpdir, dtype)
+            write_embedding_store(path, ids, vectors, dtype=dtype)
+            store = EmbeddingStore(path)
+            size = sum(os.path.getsize(os.path.join(path, f)) for f in ("vectors.npy", "scales.npy")
+                       if os.path.exists(os.path.join(path, f)))
+
+            start_time = time.perf_counter()
+            results = [set(store.top_k(q, args.k)[0]) for q in queries]
+            elapsed = time.perf_counter() - start_time
+            if truth is None:
+                truth = results
+            recall = np.mean([len(r & t) / len(t) for r, t in zip(results, truth)])
+            print(f"{dtype:<8} {size / 1e6:>9.1f}  {len(queries) / elapsed:>9.1f}  "
+                  f"{len(queries) * len(store) / elapsed:>9.3g}  {recall:>8.3f}")
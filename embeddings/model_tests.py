@@ -6,7 +6,6 @@ import os
 import sys
 import pickle
 import random
-import tempfile
 
 import numpy as np
 from sklearn.metrics.pairwise import cosine_similarity
@@ -15,6 +14,7 @@ from sklearn.metrics.pairwise import cosine_similarity
 # to allow importing from parent directory
 sys.path.insert(1, os.path.join(sys.path[0], '..'))
 from elastic.elastic_mapping import Preprint
+from embeddings.snapshot import CorpusSnapshot
 
 models = ["tf_idf"]
 num_random = 1000
@@ -33,41 +33,56 @@ def avg_distance(embeddings):
     return np.sum(diag) / sum_val
 
 
-for model in models:
-    with open(f"{model}_test_set.pkl", "rb") as f:
-        data, embeddings = pickle.load(f)
-
-    # this is a bit of a workaround because I couldn't fit everything
-    # in memory at the same time; we just read things into temp files
-    # as we're doing the calculations, and then read them back out at
-    # the end
-    with tempfile.TemporaryDirectory() as tmpdir:
-        # get average of random items
-        n = embeddings.shape[0]
-        random.seed(42)
-        idx = random.sample(range(0, n), k=num_random)
-        avg_dist = avg_distance(embeddings[idx, :])
-        with open(os.path.join(tmpdir, "random"), "w") as f:
-            f.write(str(avg_dist.item()))
-
-        # find all the ids for each category
-        categories = {}
-        for i, preprint in enumerate(data):
-            for cat in preprint.categories:
-                if cat not in categories:
-                    categories[cat] = []
-                categories[cat].append(i)
-
-        for cat, idx in categories.items():
-            avg_dist = avg_distance(embeddings[idx, :])
-            with open(os.path.join(tmpdir, cat), "w") as f:
-                if np.isnan(avg_dist):
-                    f.write("nan")
-                else:
-                    f.write(str(avg_dist.item()))
+def find_categories(data):
+    """Returns a dict mapping each category to a list of the indices of
+    the documents in `data` that have that category."""
+    if isinstance(data, CorpusSnapshot):
+        return data.category_rows()
+    categories = {}
+    for i, preprint in enumerate(data):
+        # test sets pickled before empty fields were filled in on export
+        # may not have `categories` at all
+        for cat in getattr(preprint, "categories", None) or []:
+            if cat not in categories:
+                categories[cat] = []
+            categories[cat].append(i)
+    return categories
 
+
+def category_similarities(embeddings, categories, num_random=num_random):
+    """Calculates the average cosine similarity of the embeddings of the
+    documents in each category (as returned by `find_categories()`), and
+    of a random sample of `num_random` documents. Returns a dict mapping
+    each category (and "random") to a tuple of the average similarity and
+    the number of documents."""
+    results = {}
+    for cat, idx in categories.items():
+        results[cat] = (avg_distance(embeddings[idx, :]), len(idx))
+
+    # get average of random items
+    n = embeddings.shape[0]
+    random.seed(42)
+    idx = random.sample(range(0, n), k=min(num_random, n))
+    results["random"] = (avg_distance(embeddings[idx, :]), len(idx))
+    return results
+
+
+if __name__ == "__main__":
+    from embeddings import profiling
+
+    # this has no command-line arguments, so profiling is enabled by
+    # setting PREPRINT_PROFILE (see profiling.py)
+    profiling.enable_from_env()
+
+    for model in models:
+        with profiling.span(f"Loading {model} test set"):
+            with open(f"{model}_test_set.pkl", "rb") as f:
+                data, embeddings = pickle.load(f)
+
+        with profiling.span(f"Evaluating {model}") as span:
+            categories = find_categories(data)
+            results = category_similarities(embeddings, categories)
+            span.add(len(categories))
         with open(f"{model}_cosine_test_set.txt", "w") as outfile:
-            categories["random"] = list(range(num_random))
-            for cat in categories.keys():
-                with open(os.path.join(tmpdir, cat), "r") as f:
-                    outfile.write(f"{float(f.read()):4f}\t{len(categories[cat])}\t{cat}\n")
\ No newline at end of file
+            for cat, (avg_dist, count) in results.items():
+                outfile.write(f"{float(avg_dist):4f}\t{count}\t{cat}\n")
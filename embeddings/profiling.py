@@ -0,0 +1,424 @@
+"""Profiling hooks for the training and evaluation scripts
+
+Stages of a script are marked with nested spans:
+
+    from embeddings import profiling
+
+    with profiling.span("Training model", items=len(docs)):
+        with profiling.span("Counting terms") as s:
+            ...
+            s.add(n)  # items can also be counted as they go
+
+When profiling is enabled, each span records its duration, the peak
+resident memory (RSS) of the process while it was open, and items per
+second if it counted any items. Time spent inside functions and
+iterators that are called many times within a span (e.g. tokenizing
+each document, or fetching each document from elasticsearch) can be
+added up with `profiled()` and `profiled_iter()`, and is reported with
+the span it happened in, along with the "other" time left over.
+
+When the script finishes, a summary table is printed, and a trace is
+written in the Chrome trace event format, which can be opened in
+chrome://tracing or https://ui.perfetto.dev. The trace shows the spans
+on a timeline along with a graph of memory use. Optionally, the call
+stack of the main thread can also be sampled every few milliseconds
+and added to the trace, to see inside stages that have no spans.
+
+Profiling is enabled with `enable()`, by the `--profile` argument of
+scripts that use `add_arguments()`, or by setting the PREPRINT_PROFILE
+environment variable to the trace filename (and PREPRINT_PROFILE_SAMPLE
+to a sampling interval in milliseconds). When it isn't enabled, `span()`
+returns a shared object that does nothing, and `profiled()` and
+`profiled_iter()` return what they are given, so the hooks cost almost
+nothing.
+"""
+
+import os
+import sys
+import json
+import atexit
+import threading
+from time import perf_counter
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+# the enabled profiler, if any
+profiler = None
+
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+def current_rss():
+    """Returns the resident memory of this process in bytes. Where the
+    current value can't be read (anywhere but Linux), this falls back to
+    the peak so far, or None."""
+    try:
+        with open("/proc/self/statm", "rb") as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except (OSError, IndexError, ValueError):
+        pass
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # kilobytes on Linux, bytes on macOS
+        return peak if sys.platform == "darwin" else peak * 1024
+    return None
+
+
+class _NullSpan:
+    """Stands in for a `Span` when profiling is disabled."""
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def add(self, items=1):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Span:
+    """A timed stage of a script; see `Profiler.span()`."""
+    __slots__ = ("profiler", "name", "items", "depth", "tid", "start",
+                 "end", "peak_rss", "accumulated")
+
+    def __init__(self, profiler, name, items=None):
+        self.profiler = profiler
+        self.name = name
+        self.items = items
+        self.depth = 0
+        self.tid = None
+        self.start = None
+        self.end = None
+        self.peak_rss = None
+        # name -> [seconds, calls] of `profiled()` functions and iterators
+        self.accumulated = {}
+
+    def add(self, items=1):
+        """Counts `items` more items as processed in this span."""
+        self.items = (self.items or 0) + items
+
+    def observe_rss(self, rss):
+        if rss is not None and (self.peak_rss is None or rss > self.peak_rss):
+            self.peak_rss = rss
+
+    @property
+    def duration(self):
+        return (self.end if self.end is not None else perf_counter()) - self.start
+
+    @property
+    def other_time(self):
+        """Time not accounted for by `profiled()` functions and
+        iterators."""
+        return self.duration - sum(s for s, _ in self.accumulated.values())
+
+    def __enter__(self):
+        self.profiler._open(self)
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler._close(self)
+        return False
+
+
+class Profiler:
+    """Records spans, memory use, and (optionally) sampled call stacks.
+    Memory is sampled every `memory_interval` seconds, and if
+    `sample_interval` is set, the main thread's call stack is sampled
+    every `sample_interval` seconds."""
+
+    def __init__(self, memory_interval=0.05, sample_interval=None):
+        self.memory_interval = memory_interval
+        self.sample_interval = sample_interval
+        self.spans = []
+        self.memory = []  # (time, rss)
+        self.samples = []  # (time, stack as a tuple of frame names)
+        self._origin = perf_counter()
+        self._local = threading.local()
+        self._open_spans = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._threads = []
+        self._main_thread = threading.main_thread().ident
+
+    def start(self):
+        """Starts the background threads that sample memory and call
+        stacks."""
+        self._threads.append(threading.Thread(target=self._sample_memory, daemon=True))
+        if self.sample_interval:
+            self._threads.append(threading.Thread(target=self._sample_stacks, daemon=True))
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self):
+        """Stops the background threads, and closes any spans that are
+        still open."""
+        self._stop.set()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        for span in list(self._open_spans):
+            self._close(span)
+
+    def _stack(self):
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def span(self, name, items=None):
+        """Returns a context manager that records the stage `name` while
+        it is open. `items` is the number of items the stage processes,
+        if known in advance; otherwise, items can be counted with
+        `add()` on the span."""
+        return Span(self, name, items)
+
+    def _open(self, span):
+        stack = self._stack()
+        span.depth = len(stack)
+        span.tid = threading.get_ident()
+        span.start = perf_counter()
+        span.observe_rss(current_rss())
+        stack.append(span)
+        with self._lock:
+            self.spans.append(span)
+            self._open_spans.add(span)
+
+    def _close(self, span):
+        if span.end is not None:
+            return
+        span.end = perf_counter()
+        span.observe_rss(current_rss())
+        with self._lock:
+            self._open_spans.discard(span)
+        stack = self._stack()
+        if span in stack:
+            del stack[stack.index(span):]
+
+    def _accumulate(self, name, seconds):
+        stack = self._stack()
+        if stack:
+            totals = stack[-1].accumulated.setdefault(name, [0.0, 0])
+            totals[0] += seconds
+            totals[1] += 1
+
+    def profiled(self, name, func):
+        """Returns a wrapper of `func` that adds the time spent in it to
+        the span it is called in, under `name`."""
+        def wrapper(*args, **kwargs):
+            start = perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self._accumulate(name, perf_counter() - start)
+        wrapper.__wrapped__ = func
+        return wrapper
+
+    def profiled_iter(self, name, iterable):
+        """Returns an iterator over `iterable` that adds the time spent
+        getting each item to the span it is requested in, under
+        `name`."""
+        iterator = iter(iterable)
+        while True:
+            start = perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self._accumulate(name, perf_counter() - start)
+                return
+            self._accumulate(name, perf_counter() - start)
+            yield item
+
+    def _sample_memory(self):
+        while not self._stop.is_set():
+            rss = current_rss()
+            self.memory.append((perf_counter(), rss))
+            with self._lock:
+                for span in self._open_spans:
+                    span.observe_rss(rss)
+            self._stop.wait(self.memory_interval)
+
+    def _sample_stacks(self):
+        # the sampler runs when it gets the GIL, so long-running C code
+        # that holds it (e.g. in numpy or scipy) shows up as one sample
+        names = {}
+        while not self._stop.is_set():
+            frame = sys._current_frames().get(self._main_thread)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                if code not in names:
+                    filename = os.path.basename(code.co_filename)
+                    names[code] = f"{code.co_name} ({filename}:{code.co_firstlineno})"
+                stack.append(names[code])
+                frame = frame.f_back
+            del frame
+            self.samples.append((perf_counter(), tuple(reversed(stack))))
+            self._stop.wait(self.sample_interval)
+
+    def _us(self, t):
+        return round((t - self._origin) * 1e6, 1)
+
+    def trace_events(self):
+        """Returns the recorded data as a list of Chrome trace events."""
+        pid = os.getpid()
+        thread_ids = {}
+
+        def tid(ident):
+            return thread_ids.setdefault(ident, len(thread_ids) + 1)
+
+        events = [{"name": "process_name", "ph": "M", "pid": pid, "tid": 0,
+                   "args": {"name": os.path.basename(sys.argv[0]) or "python"}}]
+        for span in self.spans:
+            args = {}
+            if span.peak_rss is not None:
+                args["peak_rss_mb"] = round(span.peak_rss / 2**20, 1)
+            if span.items is not None:
+                args["items"] = span.items
+                if span.duration > 0:
+                    args["items_per_sec"] = round(span.items / span.duration, 1)
+            for name, (seconds, calls) in span.accumulated.items():
+                args[f"{name} (s)"] = round(seconds, 4)
+                args[f"{name} (calls)"] = calls
+            if span.accumulated:
+                args["other (s)"] = round(span.other_time, 4)
+            events.append({"name": span.name, "ph": "X", "pid": pid,
+                           "tid": tid(span.tid), "ts": self._us(span.start),
+                           "dur": round(span.duration * 1e6, 1), "args": args})
+
+        for t, rss in self.memory:
+            if rss is not None:
+                events.append({"name": "memory", "ph": "C", "pid": pid,
+                               "ts": self._us(t), "args": {"rss_mb": round(rss / 2**20, 1)}})
+
+        # sampled stacks are shown as nested events on their own row,
+        # with a frame beginning when it first appears on top of the
+        # same frames and ending when it is gone
+        sample_tid = tid("samples")
+        if self.samples:
+            events.append({"name": "thread_name", "ph": "M", "pid": pid,
+                           "tid": sample_tid, "args": {"name": "sampled stacks"}})
+        samples = list(self.samples)
+        if samples:
+            # closes whatever is still open at the last sample
+            samples.append((samples[-1][0], ()))
+        previous = ()
+        for t, stack in samples:
+            common = 0
+            while (common < len(stack) and common < len(previous)
+                   and stack[common] == previous[common]):
+                common += 1
+            for name in reversed(previous[common:]):
+                events.append({"name": name, "ph": "E", "pid": pid,
+                               "tid": sample_tid, "ts": self._us(t)})
+            for name in stack[common:]:
+                events.append({"name": name, "ph": "B", "pid": pid,
+                               "tid": sample_tid, "ts": self._us(t)})
+            previous = stack
+        return events
+
+    def write_trace(self, path):
+        """Writes the recorded data to `path` as a Chrome trace."""
+        with open(path, "w") as f:
+            json.dump({"traceEvents": self.trace_events(),
+                       "displayTimeUnit": "ms"}, f)
+
+    def summary(self):
+        """Returns a table of the spans, with each nested span (and
+        `profiled()` time) indented under the span it was in."""
+        lines = [f"{'span':<40} {'time (s)':>10} {'peak RSS (MB)':>14} {'items/s':>12}"]
+        for span in self.spans:
+            rss = f"{span.peak_rss / 2**20:.1f}" if span.peak_rss is not None else ""
+            rate = ""
+            if span.items is not None and span.duration > 0:
+                rate = f"{span.items / span.duration:.1f}"
+            name = "  " * span.depth + span.name
+            lines.append(f"{name:<40} {span.duration:>10.3f} {rss:>14} {rate:>12}")
+            indent = "  " * (span.depth + 1)
+            for acc_name, (seconds, calls) in span.accumulated.items():
+                name = f"{indent}[{acc_name}] x{calls}"
+                lines.append(f"{name:<40} {seconds:>10.3f}")
+            if span.accumulated:
+                lines.append(f"{indent + '[other]':<40} {span.other_time:>10.3f}")
+        return "\n".join(lines)
+
+
+def enable(outfile, sample_interval=None, memory_interval=0.05):
+    """Enables profiling for the rest of the process. When it exits, the
+    summary is printed and the trace is written to `outfile`. If
+    `sample_interval` (in seconds) is set, call stacks are sampled too.
+    Returns the profiler."""
+    global profiler
+    if profiler is not None:
+        return profiler
+    profiler = Profiler(memory_interval=memory_interval,
+                        sample_interval=sample_interval)
+    profiler.start()
+
+    def finish():
+        profiler.stop()
+        print(profiler.summary())
+        profiler.write_trace(outfile)
+        print(f"Saved profiling trace to {outfile}")
+
+    atexit.register(finish)
+    return profiler
+
+
+def add_arguments(parser):
+    """Adds the `--profile` and `--profile_sample` arguments to an
+    argparse parser, defaulting to the PREPRINT_PROFILE and
+    PREPRINT_PROFILE_SAMPLE environment variables."""
+    parser.add_argument("--profile", nargs="?", default=os.getenv("PREPRINT_PROFILE"),
+        help="If set, profile the script and save a trace to this file, which can be opened in chrome://tracing or ui.perfetto.dev")
+    parser.add_argument("--profile_sample", nargs="?", type=float,
+        default=os.getenv("PREPRINT_PROFILE_SAMPLE"),
+        help="With --profile, also sample the call stack every this many milliseconds")
+
+
+def enable_from_args(args):
+    """Enables profiling if the arguments added by `add_arguments()` ask
+    for it."""
+    if args.profile:
+        sample = float(args.profile_sample) / 1000 if args.profile_sample else None
+        enable(args.profile, sample_interval=sample)
+
+
+def enable_from_env():
+    """Enables profiling if the PREPRINT_PROFILE environment variable is
+    set, for scripts without command-line arguments."""
+    if os.getenv("PREPRINT_PROFILE"):
+        sample = os.getenv("PREPRINT_PROFILE_SAMPLE")
+        enable(os.getenv("PREPRINT_PROFILE"),
+               sample_interval=float(sample) / 1000 if sample else None)
+
+
+def span(name, items=None):
+    """Returns a context manager for a span named `name` if profiling is
+    enabled, or one that does nothing if it isn't."""
+    if profiler is None:
+        return _NULL_SPAN
+    return profiler.span(name, items)
+
+
+def profiled(name, func):
+    """Returns `func`, wrapped to add up the time spent in it if
+    profiling is enabled."""
+    if profiler is None:
+        return func
+    return profiler.profiled(name, func)
+
+
+def profiled_iter(name, iterable):
+    """Returns `iterable`, wrapped to add up the time spent getting its
+    items if profiling is enabled."""
+    if profiler is None:
+        return iterable
+    return profiler.profiled_iter(name, iterable)
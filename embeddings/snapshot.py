@@ -0,0 +1,267 @@
+"""Local columnar snapshot of the preprint corpus
+
+Training and evaluating models both need to read the whole corpus, and
+pulling it from elasticsearch every time (and holding it in memory as
+full document objects) is slow. This stores the fields we need in a
+compact on-disk format instead, as a directory of files:
+
+    meta.json           number of documents, dictionaries for `source`
+                        and `categories`
+    doc_id.npy          elasticsearch document IDs (fixed-width bytes)
+    source_id.npy       article IDs as identified by the source
+    publish_date.npy    publish dates, as datetime64[ms]
+    source.npy          dictionary-encoded source of each document
+    cat_offsets.npy     for document i, its categories are in
+    cat_codes.npy           cat_codes[cat_offsets[i]:cat_offsets[i+1]]
+    abstract_offsets.npy    for document i, its abstract is in
+    abstracts.bin           abstracts.bin[offsets[i]:offsets[i+1]]
+
+All the arrays are memory-mapped when the snapshot is opened, so opening
+a snapshot is nearly instant and only the pages that are actually used
+are read from disk. Documents are stored in publish date order.
+
+When run directly as a script, it exports the preprint index into a new
+snapshot, e.g.:
+
+    python embeddings/snapshot.py -o data/snapshot
+"""
+
+import os
+import json
+from array import array
+from datetime import timezone
+
+import numpy as np
+from dateutil.parser import isoparse
+
+SNAPSHOT_VERSION = 1
+
+
+class SnapshotRecord:
+    """A single document read from a snapshot. Has the same attribute
+    names as `Preprint`, so it can be used in place of one by code that
+    only reads these fields."""
+    __slots__ = ("doc_id", "source_id", "source", "publish_date",
+                 "abstract", "categories")
+
+    def __init__(self, doc_id, source_id, source, publish_date, abstract,
+                 categories):
+        self.doc_id = doc_id
+        self.source_id = source_id
+        self.source = source
+        self.publish_date = publish_date
+        self.abstract = abstract
+        self.categories = categories
+
+    def __repr__(self):
+        return f"SnapshotRecord({self.source}:{self.source_id})"
+
+
+class CorpusSnapshot:
+    """Reads a corpus snapshot written by `write_snapshot()`.
+
+    Supports `len()`, iteration, and indexing. Indexing with an integer
+    returns a `SnapshotRecord`; indexing with a slice (e.g.,
+    `snapshot[1000:]`) returns another `CorpusSnapshot` that is a view
+    onto that range of documents, without copying anything. Snapshots
+    (and views) can be pickled; only the (absolute) path and range are
+    stored, and the files are memory-mapped again when unpickled.
+    """
+
+    def __init__(self, path, start=0, stop=None):
+        # absolute, so that a pickled snapshot can be loaded from any
+        # working directory
+        self.path = os.path.abspath(path)
+        with open(os.path.join(path, "meta.json"), "r") as f:
+            self.meta = json.load(f)
+        if self.meta["version"] != SNAPSHOT_VERSION:
+            raise ValueError(f"Unsupported snapshot version: {self.meta['version']}")
+        self.sources = self.meta["sources"]
+        self.category_names = self.meta["categories"]
+
+        total = self.meta["count"]
+        self.start, self.stop, _ = slice(start, stop).indices(total)
+
+        def load(name):
+            return np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r")
+
+        rows = slice(self.start, self.stop)
+        self.doc_id = load("doc_id")[rows]
+        self.source_id = load("source_id")[rows]
+        self.publish_date = load("publish_date")[rows]
+        self.source_codes = load("source")[rows]
+        # offsets keep one extra entry for the end of the last document
+        self._cat_offsets = load("cat_offsets")[self.start:self.stop + 1]
+        self._cat_codes = load("cat_codes")
+        self._abstract_offsets = load("abstract_offsets")[self.start:self.stop + 1]
+        abstract_file = os.path.join(path, "abstracts.bin")
+        if os.path.getsize(abstract_file) > 0:
+            self._abstracts = np.memmap(abstract_file, dtype=np.uint8, mode="r")
+        else:  # can't memory-map an empty file
+            self._abstracts = np.zeros(0, dtype=np.uint8)
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def __getstate__(self):
+        return {"path": self.path, "start": self.start, "stop": self.stop}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"], state["start"], state["stop"])
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(len(self))
+            if step != 1:
+                raise ValueError("Snapshot views do not support a step")
+            return CorpusSnapshot(self.path, self.start + start,
+                                  self.start + stop)
+        if i < 0:
+            i += len(self)
+        if i < 0 or i >= len(self):
+            raise IndexError("Snapshot index out of range")
+        return SnapshotRecord(
+            doc_id=self.doc_id[i].decode(),
+            source_id=self.source_id[i].decode(),
+            source=self.sources[self.source_codes[i]],
+            publish_date=self.publish_date[i].item(),
+            abstract=self.abstract(i),
+            categories=self.categories(i))
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def abstract(self, i):
+        """Returns the abstract of document `i`."""
+        start = self._abstract_offsets[i]
+        end = self._abstract_offsets[i + 1]
+        return self._abstracts[start:end].tobytes().decode("utf-8")
+
+    def abstracts(self):
+        """Generator that yields every abstract, without the overhead of
+        creating a record for each document."""
+        for i in range(len(self)):
+            yield self.abstract(i)
+
+    def categories(self, i):
+        """Returns the list of categories of document `i`."""
+        codes = self._cat_codes[self._cat_offsets[i]:self._cat_offsets[i + 1]]
+        return [self.category_names[c] for c in codes]
+
+    def category_rows(self):
+        """Returns a dict mapping each category name to an array of the
+        (zero-based) rows in this snapshot that have that category."""
+        offsets = np.asarray(self._cat_offsets)
+        codes = np.asarray(self._cat_codes[offsets[0]:offsets[-1]])
+        rows = np.repeat(np.arange(len(self)), np.diff(offsets))
+
+        order = np.argsort(codes, kind="stable")
+        codes = codes[order]
+        rows = rows[order]
+        boundaries = np.flatnonzero(np.diff(codes)) + 1
+        return {self.category_names[group_codes[0]]: group_rows
+                for group_codes, group_rows
+                in zip(np.split(codes, boundaries), np.split(rows, boundaries))
+                if len(group_codes) > 0}
+
+
+def _to_datetime64(date):
+    """Converts a date from an elasticsearch document (either an ISO
+    format string or a datetime) to milliseconds since the epoch, in
+    UTC."""
+    if date is None:
+        return np.iinfo(np.int64).min  # NaT
+    if isinstance(date, str):
+        date = isoparse(date)
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    return int(date.timestamp() * 1000)
+
+
+def write_snapshot(documents, path):
+    """Writes `documents` to a new snapshot in directory `path`.
+    `documents` can be any iterable of objects with `source_id`,
+    `source`, `publish_date`, `abstract`, and `categories` attributes
+    (e.g., the output of `export_corpus()`); the document ID is taken
+    from `_id` (or `meta.id` for a `Preprint`). Returns the number of
+    documents written.
+    """
+    os.makedirs(path, exist_ok=True)
+
+    doc_ids = []
+    source_ids = []
+    dates = array("q")
+    source_codes = array("H")
+    cat_offsets = array("q", [0])
+    cat_codes = array("H")
+    abstract_offsets = array("q", [0])
+    sources = {}
+    categories = {}
+
+    with open(os.path.join(path, "abstracts.bin"), "wb") as abstract_file:
+        for doc in documents:
+            # fields missing from a document's `_source` aren't set at all
+            doc_id = getattr(doc, "_id", None) or doc.meta.id
+            doc_ids.append(doc_id.encode())
+            source_ids.append((getattr(doc, "source_id", None) or "").encode())
+            dates.append(_to_datetime64(getattr(doc, "publish_date", None)))
+            source = getattr(doc, "source", None) or "Unknown"
+            source_codes.append(sources.setdefault(source, len(sources)))
+
+            for cat in (getattr(doc, "categories", None) or []):
+                cat_codes.append(categories.setdefault(cat, len(categories)))
+            cat_offsets.append(len(cat_codes))
+
+            abstract = (getattr(doc, "abstract", None) or "").encode("utf-8")
+            abstract_file.write(abstract)
+            abstract_offsets.append(abstract_offsets[-1] + len(abstract))
+
+    def save(name, data):
+        np.save(os.path.join(path, f"{name}.npy"), data)
+
+    save("doc_id", np.array(doc_ids, dtype=bytes))
+    save("source_id", np.array(source_ids, dtype=bytes))
+    save("publish_date", np.frombuffer(dates, dtype=np.int64).astype("datetime64[ms]"))
+    save("source", np.frombuffer(source_codes, dtype=np.uint16))
+    save("cat_offsets", np.frombuffer(cat_offsets, dtype=np.int64))
+    save("cat_codes", np.frombuffer(cat_codes, dtype=np.uint16))
+    save("abstract_offsets", np.frombuffer(abstract_offsets, dtype=np.int64))
+
+    with open(os.path.join(path, "meta.json"), "w") as f:
+        json.dump({
+            "version": SNAPSHOT_VERSION,
+            "count": len(doc_ids),
+            # dicts preserve insertion order, so these line up with codes
+            "sources": list(sources.keys()),
+            "categories": list(categories.keys()),
+        }, f)
+    return len(doc_ids)
+
+
+if __name__ == "__main__":
+    import sys
+    import time
+    import argparse
+
+    from elasticsearch_dsl import connections
+
+    # to allow importing from parent directory
+    sys.path.insert(1, os.path.join(sys.path[0], '..'))
+    from elastic.corpus_export import export_corpus
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-o", "--outdir", default="data/snapshot", nargs="?",
+        help="Directory where snapshot will be saved (default data/snapshot)")
+    parser.add_argument("--slices", default=4, nargs="?", type=int,
+        help="Number of parallel slices to read the corpus from elasticsearch with (default 4)")
+    args = parser.parse_args()
+
+    elastic_host = f"{os.getenv('ELASTIC_ADMIN_USER')}:{os.getenv('ELASTIC_ADMIN_PASS')}@{os.getenv('ELASTIC_HOST')}"
+    connections.create_connection(hosts=[elastic_host], timeout=20)
+
+    print("Exporting corpus...")
+    start_time = time.time()
+    fields = ["source", "source_id", "publish_date", "abstract", "categories"]
+    count = write_snapshot(export_corpus(slices=args.slices, fields=fields), args.outdir)
+    print(f"Saved {count} documents to {args.outdir} in {time.time() - start_time:.2f}s")
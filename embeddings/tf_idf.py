@@ -33,6 +33,11 @@ def parse_args():
         help="If set, terms with document frequency lower than `min_df` will be ignored; if this is float between 0.0 and 1.0, parameter represents proportion of documents; if integer, represents absolute count")
     parser.add_argument("--max_df", nargs="?",
         help="If set, terms with document frequency higher than `max_df` will be ignored; if this is float between 0.0 and 1.0, parameter represents proportion of documents; if integer, represents absolute count")
+    parser.add_argument("-s", "--snapshot", nargs="?",
+        help="If set, read documents from the corpus snapshot in this directory (see snapshot.py) instead of from elasticsearch")
+    parser.add_argument("--slices", default=4, nargs="?", type=int,
+        help="Number of parallel slices to read the corpus from elasticsearch with (default 4)")
+    profiling.add_arguments(parser)
     args = parser.parse_args()
 
     def min_max_convert(arg, name):
@@ -131,21 +136,37 @@ if __name__ == "__main__":
     # to allow importing from parent directory
     sys.path.insert(1, os.path.join(sys.path[0], '..'))
     from elastic.elastic_mapping import Preprint
+    from elastic.corpus_export import export_corpus
+    from embeddings.snapshot import CorpusSnapshot
+    from embeddings import profiling
 
     args = parse_args()
+    profiling.enable_from_args(args)
+    # adds up the time spent tokenizing separately from the rest of
+    # fitting and transforming (e.g. building the vocabulary)
+    tokenize = profiling.profiled("tokenize", tokenize)
+
+    if args.snapshot:
+        corpus = CorpusSnapshot(args.snapshot)
+        total = len(corpus)
+    else:
+        elastic_host = f"{os.getenv('ELASTIC_ADMIN_USER')}:{os.getenv('ELASTIC_ADMIN_PASS')}@{os.getenv('ELASTIC_HOST')}"
+        connections.create_connection(hosts=[elastic_host], timeout=20)
+        total = Preprint.search().count()
 
-    elastic_host = f"{os.getenv('ELASTIC_ADMIN_USER')}:{os.getenv('ELASTIC_ADMIN_PASS')}@{os.getenv('ELASTIC_HOST')}"
-    connections.create_connection(hosts=[elastic_host], timeout=20)
-
-    total = Preprint.search().count()
     test_set_start_idx = total - int(total * args.testprop)
     print(f"Total: {total}")
     print(f"Training set: {test_set_start_idx - 1}")
     print(f"Test set: {total - test_set_start_idx - 1}")
 
-    search = Preprint.search().sort('publish_date')
-    search._params.update(scroll="1m", size="10000")
-    search_iter = search.scan()
+    # documents come back in publish date order, so the most recent
+    # documents are the ones held out for the test set
+    if args.snapshot:
+        search_iter = iter(corpus[:test_set_start_idx])
+    else:
+        search_iter = export_corpus(slices=args.slices, ordered=True)
+    # adds up the time spent waiting for documents
+    search_iter = profiling.profiled_iter("fetch documents", search_iter)
 
     kwargs = {}
     if args.max_features:
@@ -163,24 +184,35 @@ if __name__ == "__main__":
 
     print("Training model...")
     start_time = time.time()
-    model.fit(iterate_inputs(search_iter, max=test_set_start_idx))
+    with profiling.span("Training model", items=test_set_start_idx):
+        model.fit(iterate_inputs(search_iter, max=test_set_start_idx))
     print(f"Completed in {time_elapsed(time.time() - start_time)}")
 
     print("Gathering test set...")
     start_time = time.time()
-    test_set = [item for item in search_iter]
+    with profiling.span("Gathering test set") as span:
+        if args.snapshot:
+            # a view onto the snapshot, which is pickled as just its path
+            # and range rather than as the documents themselves
+            test_set = corpus[test_set_start_idx:]
+        else:
+            test_set = [item for item in search_iter]
+        span.add(len(test_set))
     print(f"Completed in {time_elapsed(time.time() - start_time)}")
     print(f"Test set size: {len(test_set)}")  # 176,118
 
     print("Creating embeddings for test set...")
     start_time = time.time()
-    tf_idf = model.transform(test_set)
+    with profiling.span("Creating embeddings", items=len(test_set)):
+        tf_idf = model.transform(test_set)
     print(f"Completed in {time_elapsed(time.time() - start_time)}")
 
     print("Saving model and test set output...")
-    with open(args.modelfile, "wb") as f:
-        pickle.dump(model, f)
+    with profiling.span("Saving model"):
+        with open(args.modelfile, "wb") as f:
+            pickle.dump(model, f)
 
-    with open(args.outfile, "wb") as f:
-        pickle.dump((test_set, tf_idf), f)
+    with profiling.span("Saving test set", items=len(test_set)):
+        with open(args.outfile, "wb") as f:
+            pickle.dump((test_set, tf_idf), f)
     print("Complete!")
@@ -0,0 +1,207 @@
+"""Sweeps TF-IDF hyperparameters using a single tokenized corpus
+
+Trying different settings of `min_df`, `max_df`, and `max_features` with
+tf_idf.py means reading, tokenizing, and fitting the whole corpus again
+for each one. Since all of these settings just choose which terms to
+keep, this instead tokenizes the corpus once into a document-term count
+matrix, and then builds the TF-IDF embeddings for each setting by
+selecting columns of that matrix and recomputing the IDF weights from
+the document frequencies of the training set (using the same formulas
+as scikit-learn's `TfidfVectorizer`). Each setting is then evaluated on
+the test set with the category similarity metrics from model_tests.py,
+in parallel.
+
+Every combination of the values given is tried, e.g. this tries 20
+settings:
+
+    python embeddings/tf_idf_sweep.py --min_df 1 5 0.0001 0.001 \\
+        --max_df 0.5 1.0 --max_features none 50000 100000 200000
+"""
+
+import os
+import sys
+import itertools
+
+import numpy as np
+import scipy.sparse as sp
+from joblib import Parallel, delayed
+from sklearn.preprocessing import normalize
+
+# to allow importing from parent directory
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+from embeddings.model_tests import category_similarities
+
+
+def parse_df(value):
+    """Parses a `min_df` or `max_df` value: a float between 0.0 and 1.0
+    is a proportion of documents, and an integer is a count."""
+    if "." in value:
+        value = float(value)
+        if value < 0.0 or value > 1.0:
+            raise ValueError(f"Proportion {value} is not in range [0.0, 1.0]")
+        return value
+    return int(value)
+
+
+def parse_max_features(value):
+    """Parses a `max_features` value, where "none" means no limit."""
+    return None if value.lower() == "none" else int(value)
+
+
+def document_frequencies(counts):
+    """Returns the number of documents each term appears in, and the
+    total count of each term, for a sparse document-term count matrix."""
+    counts = sp.csc_matrix(counts)
+    return (np.diff(counts.indptr), np.asarray(counts.sum(axis=0)).ravel())
+
+
+def select_terms(df, tf, n_docs, min_df=1, max_df=1.0, max_features=None):
+    """Returns the indices of the terms that `TfidfVectorizer` would keep
+    with these settings, given the document frequency `df` and total
+    count `tf` of each term in `n_docs` training documents."""
+    max_count = max_df if isinstance(max_df, int) else max_df * n_docs
+    min_count = min_df if isinstance(min_df, int) else min_df * n_docs
+    terms = np.flatnonzero((df >= min_count) & (df <= max_count))
+    if max_features is not None and len(terms) > max_features:
+        # keep the most frequent terms across the training set (terms
+        # tied at the cutoff may be chosen differently than scikit-learn)
+        top = np.argsort(-tf[terms], kind="stable")[:max_features]
+        terms = np.sort(terms[top])
+    return terms
+
+
+def tf_idf_from_counts(counts, df, n_docs, terms):
+    """Builds L2-normalized TF-IDF embeddings from a document-term count
+    matrix, keeping only `terms`, with smoothed IDF weights computed from
+    training set document frequencies `df` of `n_docs` documents."""
+    idf = np.log((1 + n_docs) / (1 + df[terms])) + 1
+    embeddings = sp.csr_matrix(counts[:, terms], dtype=np.float64) @ sp.diags(idf)
+    return normalize(embeddings, norm="l2", copy=False)
+
+
+def evaluate_setting(test_counts, df, tf, n_train, categories, setting):
+    """Builds the embeddings for one setting of `(min_df, max_df,
+    max_features)` and returns a dict of summary metrics."""
+    min_df, max_df, max_features = setting
+    terms = select_terms(df, tf, n_train, min_df, max_df, max_features)
+    embeddings = tf_idf_from_counts(test_counts, df, n_train, terms)
+    results = category_similarities(embeddings, categories)
+
+    random_sim = results.pop("random")[0]
+    sims = np.array([r[0] for r in results.values()], dtype=float)
+    sizes = np.array([r[1] for r in results.values()], dtype=float)
+    valid = ~np.isnan(sims)
+    category_sim = np.average(sims[valid], weights=sizes[valid]) if valid.any() else np.nan
+    return {
+        "min_df": min_df,
+        "max_df": max_df,
+        "max_features": max_features,
+        "vocab_size": len(terms),
+        "random": random_sim,
+        "category": category_sim,
+        # how much more similar documents in the same category are than
+        # random documents; higher is better
+        "separation": category_sim - random_sim,
+    }
+
+
+if __name__ == "__main__":
+    import time
+    import argparse
+
+    from elasticsearch_dsl import connections
+    from sklearn.feature_extraction.text import CountVectorizer
+
+    from elastic.elastic_mapping import Preprint
+    from elastic.corpus_export import export_corpus
+    from embeddings.snapshot import CorpusSnapshot
+    from embeddings.model_tests import find_categories
+    from embeddings import profiling
+    from embeddings import tf_idf
+    from embeddings.tf_idf import tokenizer, time_elapsed
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-o", "--outfile", default="tf_idf_sweep.txt", nargs="?",
+        help="Filename where results will be saved (default tf_idf_sweep.txt)")
+    parser.add_argument("-s", "--snapshot", nargs="?",
+        help="If set, read documents from the corpus snapshot in this directory (see snapshot.py) instead of from elasticsearch")
+    parser.add_argument("--testprop", default=0.1, nargs="?", type=float,
+        help="Proportion of documents to include in test set (default 0.1)")
+    parser.add_argument("--min_df", nargs="+", type=parse_df, default=[1],
+        help="Values of `min_df` to try; floats between 0.0 and 1.0 are proportions of documents, integers are counts (default 1)")
+    parser.add_argument("--max_df", nargs="+", type=parse_df, default=[1.0],
+        help="Values of `max_df` to try (default 1.0)")
+    parser.add_argument("--max_features", nargs="+", type=parse_max_features, default=[None],
+        help="Values of `max_features` to try, or 'none' for no limit (default none)")
+    parser.add_argument("-j", "--jobs", type=int, default=2, nargs="?",
+        help="Number of settings to evaluate in parallel; each one builds a dense similarity matrix for each category, so memory use grows with this (default 2)")
+    profiling.add_arguments(parser)
+    args = parser.parse_args()
+    profiling.enable_from_args(args)
+    # `tokenizer()` looks up `tokenize` in the tf_idf module, so this adds
+    # up the time spent tokenizing separately from counting terms
+    tf_idf.tokenize = profiling.profiled("tokenize", tf_idf.tokenize)
+
+    if args.snapshot:
+        corpus = CorpusSnapshot(args.snapshot)
+        total = len(corpus)
+    else:
+        elastic_host = f"{os.getenv('ELASTIC_ADMIN_USER')}:{os.getenv('ELASTIC_ADMIN_PASS')}@{os.getenv('ELASTIC_HOST')}"
+        connections.create_connection(hosts=[elastic_host], timeout=20)
+        total = Preprint.search().count()
+    test_set_start_idx = total - int(total * args.testprop)
+    print(f"Training set: {test_set_start_idx}")
+    print(f"Test set: {total - test_set_start_idx}")
+
+    # documents come back in publish date order, so the most recent
+    # documents are the ones held out for the test set; the training set
+    # is streamed into the vectorizer rather than held in memory
+    if args.snapshot:
+        search_iter = iter(corpus[:test_set_start_idx])
+    else:
+        search_iter = export_corpus(ordered=True)
+    # adds up the time spent waiting for documents
+    search_iter = profiling.profiled_iter("fetch documents", search_iter)
+
+    # this is the only time the corpus is tokenized
+    print("Counting terms...")
+    start_time = time.time()
+    vectorizer = CountVectorizer(lowercase=False, tokenizer=tokenizer, token_pattern=None)
+    with profiling.span("Counting terms", items=total):
+        with profiling.span("Training set", items=test_set_start_idx):
+            train_counts = vectorizer.fit_transform(
+                itertools.islice(search_iter, test_set_start_idx))
+        n_train = train_counts.shape[0]
+        with profiling.span("Test set") as span:
+            if args.snapshot:
+                test_set = corpus[test_set_start_idx:]
+            else:
+                test_set = list(search_iter)
+            span.add(len(test_set))
+            test_counts = vectorizer.transform(test_set).tocsc()
+        df, tf = document_frequencies(train_counts)
+    del train_counts
+    print(f"Completed in {time_elapsed(time.time() - start_time)}")
+    print(f"Vocabulary size: {len(df)}")
+
+    settings = list(itertools.product(args.min_df, args.max_df, args.max_features))
+    print(f"Evaluating {len(settings)} settings...")
+    start_time = time.time()
+    # each setting is evaluated in a worker process, so only the total
+    # time (and the memory of this process) is recorded
+    with profiling.span("Evaluating settings", items=len(settings)):
+        categories = find_categories(test_set)
+        results = Parallel(n_jobs=args.jobs)(
+            delayed(evaluate_setting)(test_counts, df, tf, n_train, categories, s)
+            for s in settings)
+    print(f"Completed in {time_elapsed(time.time() - start_time)}")
+
+    results.sort(key=lambda r: -r["separation"] if not np.isnan(r["separation"]) else np.inf)
+    columns = ["min_df", "max_df", "max_features", "vocab_size", "random", "category", "separation"]
+    with open(args.outfile, "w") as f:
+        f.write("\t".join(columns) + "\n")
+        for r in results:
+            f.write("\t".join(f"{r[c]:.4f}" if isinstance(r[c], float) else str(r[c])
+                              for c in columns) + "\n")
+    print(f"Best: min_df={results[0]['min_df']}, max_df={results[0]['max_df']}, "
+          f"max_features={results[0]['max_features']} (separation {results[0]['separation']:.4f})")
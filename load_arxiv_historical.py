@@ -11,9 +11,11 @@ import json
 from datetime import datetime
 
 from elasticsearch_dsl import connections
-from elasticsearch.helpers import bulk
 
 from elastic.elastic_mapping import Preprint
+from elastic.authors import author_keys
+from elastic.cache import bump_generation
+from elastic.partitions import bulk_index, partitions, unblocked
 
 # this is historical arXiv data, downloaded from Kaggle:
 # https://www.kaggle.com/Cornell-University/arxiv
@@ -57,38 +59,53 @@ def convert_category(cat):
         return cat
 
 
-elastic_host = f"{os.getenv('ELASTIC_ADMIN_USER')}:{os.getenv('ELASTIC_ADMIN_PASS')}@{os.getenv('ELASTIC_HOST')}"
-connections.create_connection(hosts=[elastic_host], timeout=20)
-
-with open(file, "r") as f:
-    documents = []
-    i = 0
-    for line in f:
-        data = json.loads(line)
-        categories = data["categories"].split(" ")
-        categories = [convert_category(c) for c in categories]
-
-        preprint = Preprint(
-            url=f"https://arxiv.org/abs/{data['id']}",
-            source="arXiv",
-            source_id=data["id"],
-            publish_date=to_datetime(data["versions"][0]["created"]),
-            modified_date=to_datetime(data["versions"][len(data["versions"])-1]["created"]),
-            stored_date=datetime.now(),
-            title=strip_newlines(data["title"]),
-            # TODO: Need to figure out how to deal with LaTeX code
-            abstract=strip_newlines(data["abstract"]),
-            # TODO: Format authors appropriately;
-            # also deal with special characters
-            authors=data["authors"],
-            categories=categories
-        )
-        documents.append(preprint)
-        i += 1
-        if i % 1000 == 0:
-            print(f"Adding {len(documents)} documents ({i} so far) to database [{datetime.now()}]")
-            bulk(connections.get_connection(), (d.to_dict(True) for d in documents))
-            documents = []
-    
-    print(f"Adding {len(documents)} documents ({i} so far) to database [{datetime.now()}]")
-    bulk(connections.get_connection(), (d.to_dict(True) for d in documents))
\ No newline at end of file
+def to_preprint(data):
+    """Converts one record (a parsed line) of the arXiv metadata
+    snapshot to a `Preprint`."""
+    categories = data["categories"].split(" ")
+    categories = [convert_category(c) for c in categories]
+
+    return Preprint(
+        url=f"https://arxiv.org/abs/{data['id']}",
+        source="arXiv",
+        source_id=data["id"],
+        publish_date=to_datetime(data["versions"][0]["created"]),
+        modified_date=to_datetime(data["versions"][len(data["versions"])-1]["created"]),
+        stored_date=datetime.now(),
+        title=strip_newlines(data["title"]),
+        # TODO: Need to figure out how to deal with LaTeX code
+        abstract=strip_newlines(data["abstract"]),
+        # TODO: Format authors appropriately;
+        # also deal with special characters
+        authors=data["authors"],
+        author_keys=author_keys(data["authors"]),
+        categories=categories
+    )
+
+
+if __name__ == "__main__":
+    elastic_host = f"{os.getenv('ELASTIC_ADMIN_USER')}:{os.getenv('ELASTIC_ADMIN_PASS')}@{os.getenv('ELASTIC_HOST')}"
+    connections.create_connection(hosts=[elastic_host], timeout=20)
+
+    client = connections.get_connection()
+    existing = [name for _, name in partitions(client)]
+
+    # if partitions have been finalized (e.g., this is a reload), lift
+    # their write blocks for the whole load and finalize them once at
+    # the end
+    with unblocked(client, existing), open(file, "r") as f:
+        documents = []
+        i = 0
+        for line in f:
+            documents.append(to_preprint(json.loads(line)))
+            i += 1
+            if i % 1000 == 0:
+                print(f"Adding {len(documents)} documents ({i} so far) to database [{datetime.now()}]")
+                bulk_index(documents)
+                documents = []
+
+        print(f"Adding {len(documents)} documents ({i} so far) to database [{datetime.now()}]")
+        bulk_index(documents)
+
+        # let any result caches know that there are new preprints
+        bump_generation(connections.get_connection())
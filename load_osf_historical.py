@@ -13,9 +13,11 @@ import pickle
 from datetime import datetime
 
 from elasticsearch_dsl import connections
-from elasticsearch.helpers import bulk
 
 from elastic.elastic_mapping import Preprint
+from elastic.authors import author_keys
+from elastic.cache import bump_generation
+from elastic.partitions import bulk_index, partitions, unblocked
 
 # this is historical data from OSF Preprints, downloaded via the API,
 # containing 57,730 articles from 2016-07-13 to 2020-06-31
@@ -81,52 +83,68 @@ def get_authors(contributors):
     return authors
 
 
-elastic_host = f"{os.getenv('ELASTIC_ADMIN_USER')}:{os.getenv('ELASTIC_ADMIN_PASS')}@{os.getenv('ELASTIC_HOST')}"
-connections.create_connection(hosts=[elastic_host], timeout=20)
-
-documents = []
-i = 0
-for fl in input_files:
-    with open(fl, "rb") as f:
-        data_block = pickle.load(f)
-
-    for item in data_block:
-        data = item["data"]
-        pub_date = data["attributes"]["date_published"]
-        if pub_date is None:
-            pub_date = data["attributes"]["date_created"]
-
-        # turns hierarchy of categories into a flat list of categories,
-        # with lower-level categories denoted by " > "
-        # e.g., "Business > Accounting"
-        all_categories = data["attributes"]["subjects"]
-        categories = []
-        for group in all_categories:
-            chain = [c["text"] for c in group]
-            text = " > ".join(chain[:2])  # max. 2 levels
-            categories.append(text)
-
-        preprint = Preprint(
-            url=data["links"]["html"],
-            source=get_provider(data["relationships"]["provider"]["links"]["related"]["href"]),
-            source_id=data["id"],
-            publish_date=datetime.fromisoformat(pub_date),
-            modified_date=datetime.fromisoformat(data["attributes"]["date_modified"]),
-            stored_date=datetime.now(),
-            title=data["attributes"]["title"],
-            # TODO: Need to figure out how to deal with LaTeX code
-            abstract=data["attributes"]["description"],
-            # TODO: Format authors appropriately;
-            # also deal with special characters
-            authors=get_authors(data["embeds"]["contributors"]),
-            categories=categories
-        )
-        documents.append(preprint)
-        i += 1
-        if i % 1000 == 0:
-            print(f"Adding {len(documents)} documents ({i} so far) to database [{datetime.now()}]")
-            bulk(connections.get_connection(), (d.to_dict(True) for d in documents))
-            documents = []
-
-print(f"Adding {len(documents)} documents ({i} so far) to database [{datetime.now()}]")
-bulk(connections.get_connection(), (d.to_dict(True) for d in documents))
\ No newline at end of file
+def to_preprint(item):
+    """Converts one preprint record from the OSF API to a `Preprint`."""
+    data = item["data"]
+    pub_date = data["attributes"]["date_published"]
+    if pub_date is None:
+        pub_date = data["attributes"]["date_created"]
+
+    # turns hierarchy of categories into a flat list of categories,
+    # with lower-level categories denoted by " > "
+    # e.g., "Business > Accounting"
+    all_categories = data["attributes"]["subjects"]
+    categories = []
+    for group in all_categories:
+        chain = [c["text"] for c in group]
+        text = " > ".join(chain[:2])  # max. 2 levels
+        categories.append(text)
+
+    authors = get_authors(data["embeds"]["contributors"])
+    return Preprint(
+        url=data["links"]["html"],
+        source=get_provider(data["relationships"]["provider"]["links"]["related"]["href"]),
+        source_id=data["id"],
+        publish_date=datetime.fromisoformat(pub_date),
+        modified_date=datetime.fromisoformat(data["attributes"]["date_modified"]),
+        stored_date=datetime.now(),
+        title=data["attributes"]["title"],
+        # TODO: Need to figure out how to deal with LaTeX code
+        abstract=data["attributes"]["description"],
+        # TODO: Format authors appropriately;
+        # also deal with special characters
+        authors=authors,
+        author_keys=author_keys(authors),
+        categories=categories
+    )
+
+
+if __name__ == "__main__":
+    elastic_host = f"{os.getenv('ELASTIC_ADMIN_USER')}:{os.getenv('ELASTIC_ADMIN_PASS')}@{os.getenv('ELASTIC_HOST')}"
+    connections.create_connection(hosts=[elastic_host], timeout=20)
+
+    client = connections.get_connection()
+
+    # backdated preprints may go to partitions that have been finalized,
+    # so lift their write blocks for the whole load and finalize them
+    # once at the end
+    with unblocked(client, [name for _, name in partitions(client)]):
+        documents = []
+        i = 0
+        for fl in input_files:
+            with open(fl, "rb") as f:
+                data_block = pickle.load(f)
+
+            for item in data_block:
+                documents.append(to_preprint(item))
+                i += 1
+                if i % 1000 == 0:
+                    print(f"Adding {len(documents)} documents ({i} so far) to database [{datetime.now()}]")
+                    bulk_index(documents)
+                    documents = []
+
+        print(f"Adding {len(documents)} documents ({i} so far) to database [{datetime.now()}]")
+        bulk_index(documents)
+
+    # let any result caches know that there are new preprints
+    bump_generation(connections.get_connection())
@@ -42,7 +42,8 @@ if [ "$LOAD_DATA" = true ]; then
     echo "Initializing database and loading data..."
     ./scripts/db_init.sh \
         && python3 load_arxiv_historical.py \
-        && python3 load_osf_historical.py
+        && python3 load_osf_historical.py \
+        && python3 -m elastic.partitions --finalize
 else
     # this would be useful for restarting the app, where we still
     # have data in the database
@@ -72,4 +72,31 @@ print(search)
 
 # iterate with this
 search2 = es.scroll(scroll_id=search["_scroll_id"], params={"scroll": "1m"})
-print(search2)
\ No newline at end of file
+print(search2)
+
+# for anything performance-sensitive, the helpers in elastic/query.py
+# only fetch the fields that are needed and skip building full Preprint
+# objects
+
+from elastic.query import search_preprints, msearch_preprints
+
+total, hits = search_preprints({"match_phrase": {"title": "reinforcement learning"}})
+print(total)
+print(hits[0].title, hits[0].url, hits[0].categories)
+
+# several queries in one round-trip
+results = msearch_preprints([
+    {"match": {"title": "reinforcement learning"}},
+    {"match": {"title": "social psychology"}},
+], size=5)
+for total, hits in results:
+    print(total, [h.title for h in hits])
+
+# searches for recent preprints only query the yearly partitions that
+# cover the date range
+from datetime import datetime, timedelta
+
+total, hits = search_preprints({"match": {"title": "learning"}},
+                               published_after=datetime.now() - timedelta(days=30),
+                               sort=[{"publish_date": "desc"}], track_total_hits=False)
+print([(h.publish_date, h.title) for h in hits])